@@ -0,0 +1,395 @@
+"""
+Offline benchmark / load test for VoiceChatMusicBot.
+
+Drives the real bot code against in-process fakes of TelegramClient and
+yt_dlp.YoutubeDL, so no Telegram or YouTube access is needed.
+
+A share of the groups (--media-rate) get forwarded Telegram media instead of a
+YouTube link; some of those (--media-expired-rate) carry a stale file reference,
+so the bot has to download and re-upload them.
+
+Every /play needs a download slot, so with the defaults most plays beyond
+DOWNLOAD_WORKERS + DOWNLOAD_QUEUE_LIMIT are rejected (reported separately).
+To measure throughput rather than admission control, raise the limits:
+
+    DOWNLOAD_QUEUE_LIMIT=1000 SCRATCH_QUOTA_MB=100000 python bench.py --groups 300
+
+Usage:
+    python bench.py --groups 300 --rpc-latency 0.05 --download-latency 0.5
+    python bench.py --groups 100 --flood-rate 0.05 --json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+from unittest import mock
+
+from telethon import errors, types
+
+import bot
+
+logger = logging.getLogger('bench')
+
+OWNER_ID = bot.OWNERS[0]
+CANNED_AUDIO = b'OggS' * 64 * 1024  # 256 KB of "audio"
+
+# ================= FAKE TELEGRAM =================
+class FakeMessage:
+    def __init__(self, chat_id, msg_id, document=None):
+        self.chat_id = chat_id
+        self.id = msg_id
+        self.document = document
+
+
+class FakeMediaMessage(FakeMessage):
+    """Forwarded audio document, downloaded through its client like a Telethon message"""
+    video = None
+
+    def __init__(self, client, chat_id, msg_id, size):
+        name = f"track_{msg_id}.mp3"
+        document = types.Document(
+            id=random.getrandbits(62), access_hash=1, file_reference=b'ref', date=None,
+            mime_type='audio/mpeg', size=size, dc_id=1,
+            attributes=[types.DocumentAttributeFilename(file_name=name)]
+        )
+        super().__init__(chat_id, msg_id, document)
+        self.client = client
+        self.media = types.MessageMediaDocument(document=document)
+        self.file = mock.Mock(size=size, duration=1)
+        self.file.name = name
+
+    async def download_media(self, file=None):
+        return await self.client.download_media(self, file)
+
+
+class FakeTelegramClient:
+    """Stand-in for TelegramClient with configurable latency and FloodWait injection"""
+    def __init__(self, latency=0.05, flood_rate=0.0, flood_seconds=1):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.handlers = []
+        self.calls = {}  # method name -> count
+        self.files_sent = {}  # chat_id -> time of the last send_file
+        self.messages = {}  # (chat_id, msg_id) -> FakeMediaMessage
+        self.expired = set()  # document IDs whose file reference can no longer be resent
+        self.rejected = set()  # (chat_id, msg_id) of "try again later" messages
+        self.next_id = 1
+        self.next_doc = 1
+
+    async def _rpc(self, name, floodable=False):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if floodable and random.random() < self.flood_rate:
+            raise errors.FloodWaitError(request=None, capture=self.flood_seconds)
+
+    def _message(self, chat_id, document=None):
+        self.next_id += 1
+        return FakeMessage(chat_id, self.next_id, document)
+
+    def is_connected(self):
+        return True
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append((callback, event))
+
+    async def __call__(self, request):
+        name = type(request).__name__
+        await self._rpc(name)
+        if name in ('GetFullChatRequest', 'GetFullChannelRequest'):
+            call = types.InputGroupCall(id=abs(hash(str(request))) % 10**9, access_hash=1)
+            return mock.Mock(full_chat=mock.Mock(call=call))
+        return None
+
+    async def send_message(self, chat_id, text, reply_to=None, **kwargs):
+        await self._rpc('send_message', floodable=True)
+        message = self._message(chat_id)
+        if text.startswith('⏳'):
+            self.rejected.add((chat_id, message.id))
+        return message
+
+    async def edit_message(self, chat_id, message_id, text, **kwargs):
+        await self._rpc('edit_message', floodable=True)
+        if text.startswith('⏳'):
+            self.rejected.add((chat_id, message_id))
+        return self._message(chat_id)
+
+    async def get_entity(self, username):
+        await self._rpc('get_entity')
+        bare_id = int(username.rsplit('_', 1)[1])
+        return types.Channel(
+            id=bare_id, title=f"Group {bare_id}", photo=types.ChatPhotoEmpty(),
+            date=None, access_hash=1, megagroup=True, username=username
+        )
+
+    async def send_file(self, chat_id, file, caption=None, **kwargs):
+        await self._rpc('send_file', floodable=True)
+        if isinstance(file, types.InputDocument) and file.id in self.expired:
+            raise errors.FileReferenceExpiredError(request=None)
+        if isinstance(file, str):
+            # Simulated upload time, proportional to size
+            await asyncio.sleep(os.path.getsize(file) / (20 * 1024 * 1024))
+        self.next_doc += 1
+        document = types.Document(
+            id=self.next_doc, access_hash=1, file_reference=b'ref', date=None,
+            mime_type='audio/mpeg', size=len(CANNED_AUDIO), dc_id=1, attributes=[]
+        )
+        self.files_sent[chat_id] = time.perf_counter()
+        return self._message(chat_id, document)
+
+    async def get_messages(self, chat_id, ids=None):
+        await self._rpc('get_messages')
+        return self.messages.get((chat_id, ids))
+
+    def forward_media(self, chat_id, size, expired=False):
+        """A media message as if it had been forwarded to the bot"""
+        self.next_id += 1
+        message = FakeMediaMessage(self, chat_id, self.next_id, size)
+        self.messages[(chat_id, message.id)] = message
+        if expired:
+            self.expired.add(message.document.id)
+        return message
+
+    async def download_media(self, message, file=None):
+        await self._rpc('download_media')
+        # Simulated download time, proportional to size
+        await asyncio.sleep(message.file.size / (20 * 1024 * 1024))
+        with open(file, 'wb') as f:
+            f.write(CANNED_AUDIO * (message.file.size // len(CANNED_AUDIO) + 1))
+        return file
+
+    async def iter_download(self, media, offset=0, limit=None, request_size=128 * 1024, file_size=None, **kwargs):
+        # The canned audio repeats up to the document's size, so parallel part downloads see the whole file
+        size = file_size or getattr(getattr(media, 'document', None), 'size', None) or len(CANNED_AUDIO)
+        count = 0
+        while offset < size and (limit is None or count < limit):
+            await self._rpc('iter_download')
+            end = min(offset + request_size, size)
+            start = offset % len(CANNED_AUDIO)
+            yield (CANNED_AUDIO * (request_size // len(CANNED_AUDIO) + 2))[start:start + end - offset]
+            offset = end
+            count += 1
+
+
+class FakeEvent:
+    """Enough of events.NewMessage.Event for the router and /play path"""
+    def __init__(self, client, chat_id, msg_id, text):
+        self.client = client
+        self.chat_id = chat_id
+        self.id = msg_id
+        self.sender_id = OWNER_ID
+        self.raw_text = text
+        self.text = text
+        self.is_reply = False
+        self.is_private = False
+        self.message = mock.Mock(media=None)
+        self.reply_message = None
+
+    async def get_reply_message(self):
+        return self.reply_message
+
+    async def reply(self, text):
+        return await self.client.send_message(self.chat_id, text, reply_to=self.id)
+
+    async def get_chat(self):
+        bare_id = bot.utils.resolve_id(self.chat_id)[0]
+        return types.Channel(
+            id=bare_id, title=f"Group {bare_id}", photo=types.ChatPhotoEmpty(),
+            date=None, access_hash=1, megagroup=True
+        )
+
+# ================= FAKE YT-DLP =================
+def make_fake_youtube_dl(download_latency):
+    class FakeYoutubeDL:
+        """Stand-in for yt_dlp.YoutubeDL that 'downloads' canned audio"""
+        def __init__(self, opts=None):
+            self.opts = opts or {}
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def extract_info(self, url, download=True):
+            video_id = url.rsplit('/', 1)[-1][-11:]
+            info = {
+                'id': video_id,
+                'extractor_key': 'Youtube',
+                'title': f"Track {video_id}",
+                'duration': 1,
+                'ext': 'webm',
+                'acodec': 'opus',
+                'url': url,
+            }
+            return self.process_ie_result(info, download) if download else info
+
+        def process_ie_result(self, info, download=True):
+            for hook in self.opts.get('progress_hooks', []):
+                hook({'status': 'downloading'})
+            time.sleep(download_latency * random.uniform(0.5, 1.5))
+
+            for hook in self.opts.get('postprocessor_hooks', []):
+                hook({'status': 'started'})
+            codec = self.opts.get('postprocessors', [{}])[0].get('preferredcodec', 'best')
+            ext = {'best': 'opus', 'm4a': 'm4a', 'opus': 'opus', 'mp3': 'mp3'}[codec]
+            target = os.path.splitext(self.prepare_filename(info))[0] + '.' + ext
+            os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(CANNED_AUDIO)
+            for hook in self.opts.get('postprocessor_hooks', []):
+                hook({'status': 'finished'})
+            return dict(info, requested_downloads=[{'filepath': target}])
+
+        def prepare_filename(self, info):
+            return self.opts.get('outtmpl', '%(id)s.%(ext)s') % info
+
+    return FakeYoutubeDL
+
+# ================= BENCHMARK =================
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def plays_finished():
+    with bot.metrics.lock:
+        return sum(v for (name, _), v in bot.metrics.counters.items() if name == 'bot_plays_total')
+
+
+async def run_benchmark(args):
+    bot_client = FakeTelegramClient(args.rpc_latency, args.flood_rate, args.flood_seconds)
+    user_client = FakeTelegramClient(args.rpc_latency)
+
+    music_bot = bot.VoiceChatMusicBot()
+    music_bot.bot_client = bot_client
+    music_bot.user_client = user_client
+    music_bot.outbox.client = bot_client
+    music_bot.bot_username = 'benchbot'
+    music_bot.accounts.adopt(user_client)
+    music_bot.setup_handlers()
+
+    # Every group asks for one of a few hundred tracks, like production traffic
+    groups = [-1001000000000 - i for i in range(args.groups)]
+    tracks = [f"https://youtu.be/{i:011d}" for i in range(args.tracks)]
+
+    # Forwarded media is sent to the bot in private and /play'd into a group by username. Each
+    # comes from its own private chat, so the per-chat outbox limit does not serialize them
+    media_groups = set(random.sample(groups, int(len(groups) * args.media_rate)))
+
+    started_at = {}
+    routes = []
+    dispatch_started = time.perf_counter()
+    for i, chat_id in enumerate(groups):
+        if chat_id in media_groups:
+            private_chat = 10**9 + i
+            event = FakeEvent(bot_client, private_chat, i + 1, f"/play @bench_{bot.utils.resolve_id(chat_id)[0]}")
+            event.is_reply = True
+            event.is_private = True
+            event.reply_message = bot_client.forward_media(
+                private_chat, args.media_kb * 1024, expired=random.random() < args.media_expired_rate
+            )
+        else:
+            event = FakeEvent(bot_client, chat_id, i + 1, f"/play {random.choice(tracks)}")
+        if not music_bot.parse_command(event):
+            raise RuntimeError("Router rejected /play")
+        started_at[chat_id] = time.perf_counter()
+        routes.append(asyncio.create_task(music_bot.route(event)))
+
+    # Commands/sec covers the handlers (parse, reply, enqueue), not the plays they schedule
+    await asyncio.gather(*routes)
+    dispatch_seconds = time.perf_counter() - dispatch_started
+
+    # Wait until every play has either sent its file or failed
+    deadline = time.perf_counter() + args.timeout
+    while plays_finished() < len(groups) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    total_seconds = time.perf_counter() - dispatch_started
+
+    # Every group sends /stopmusic; the account must leave and forget each voice chat
+    joined = len(music_bot.active_calls)
+    stops = []
+    for i, chat_id in enumerate(groups):
+        event = FakeEvent(bot_client, chat_id, len(groups) + i + 1, "/stopmusic")
+        if not music_bot.parse_command(event):
+            raise RuntimeError("Router rejected /stopmusic")
+        stops.append(asyncio.create_task(music_bot.route(event)))
+    await asyncio.gather(*stops)
+    music_bot.store.flush()
+    still_joined = set(music_bot.active_calls) | {int(c) for c in music_bot.store.load('calls')}
+
+    music_bot.downloads.shutdown()
+    music_bot.store.close()
+
+    latencies = [bot_client.files_sent[c] - started_at[c] for c in groups if c in bot_client.files_sent]
+    rejected = len(bot_client.rejected)
+    return {
+        'groups': len(groups),
+        'media_groups': len(media_groups),
+        'completed': len(latencies),
+        'rejected': rejected,
+        'failed': plays_finished() - len(latencies) - rejected,
+        'joined': joined,
+        'stop_failed': len(still_joined),
+        'commands_per_sec': round(len(groups) / max(dispatch_seconds, 1e-9), 1),
+        'plays_per_sec': round(len(latencies) / max(total_seconds, 1e-9), 2),
+        'play_latency_p50': round(percentile(latencies, 50), 3),
+        'play_latency_p99': round(percentile(latencies, 99), 3),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'bot_rpcs': dict(sorted(bot_client.calls.items())),
+        'flood_wait_seconds': music_bot.outbox.flood_wait_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline /play benchmark with fake Telegram and yt-dlp")
+    parser.add_argument('--groups', type=int, default=200, help="groups sending /play at once")
+    parser.add_argument('--tracks', type=int, default=50, help="distinct tracks requested")
+    parser.add_argument('--rpc-latency', type=float, default=0.05, help="seconds per fake Telegram RPC")
+    parser.add_argument('--download-latency', type=float, default=0.5, help="seconds per fake download")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="probability a send raises FloodWait")
+    parser.add_argument('--flood-seconds', type=int, default=1, help="FloodWait duration to inject")
+    parser.add_argument('--media-rate', type=float, default=0.2, help="share of groups playing forwarded media")
+    parser.add_argument('--media-expired-rate', type=float, default=0.5,
+                        help="share of forwarded media that must be downloaded and re-uploaded")
+    parser.add_argument('--media-kb', type=int, default=2048, help="size of each forwarded media file")
+    parser.add_argument('--timeout', type=float, default=300, help="give up after this many seconds")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, force=True)
+
+    # Caches and queue state go to a throwaway directory
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    os.chdir(workdir)
+
+    with mock.patch.object(bot.load_yt_dlp(), 'YoutubeDL', make_fake_youtube_dl(args.download_latency)):
+        report = asyncio.run(run_benchmark(args))
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"groups:            {report['groups']} ({report['media_groups']} with forwarded media)")
+    print(f"plays:             {report['completed']} completed, {report['rejected']} rejected, {report['failed']} failed")
+    print(f"/stopmusic:        {report['joined'] - report['stop_failed']} of {report['joined']} voice chats left")
+    print(f"commands/sec:      {report['commands_per_sec']}")
+    print(f"plays/sec:         {report['plays_per_sec']}")
+    print(f"/play latency p50: {report['play_latency_p50']}s")
+    print(f"/play latency p99: {report['play_latency_p99']}s")
+    print(f"peak RSS:          {report['peak_rss_mb']} MB")
+    print(f"FloodWait seconds: {report['flood_wait_seconds']}")
+    print(f"bot RPCs:          {report['bot_rpcs']}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,10 +6,27 @@ import threading
 import re
 import json
 import time
+import random
+import bisect
+import hashlib
+import shutil
+import functools
+import itertools
+import resource
+import multiprocessing
 import traceback
-from flask import Flask, jsonify
-from telethon import TelegramClient, events, functions, types
-import yt_dlp
+import sqlite3
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Startup timings are measured from here, so the third-party imports below count as 'imports'
+PROCESS_STARTED = time.perf_counter()
+
+from flask import Flask, Response, jsonify  # noqa: E402
+from telethon import TelegramClient, events, functions, types, errors, utils  # noqa: E402
+from telethon.extensions import BinaryReader  # noqa: E402
+
+IMPORT_SECONDS = time.perf_counter() - PROCESS_STARTED
 
 # Configure logging
 logging.basicConfig(
@@ -27,189 +44,1744 @@ USER_API_ID = os.getenv('USER_API_ID', '')
 USER_API_HASH = os.getenv('USER_API_HASH', '')
 USER_PHONE = os.getenv('USER_PHONE', '')  # Optional: phone number for login
 
+# More user accounts for joining voice chats, started on first use ('user_session' is always the first).
+# When sharded, each worker gets its own share (worker n takes every WORKERS-th one starting at n)
+USER_SESSIONS = [s for s in os.getenv('USER_SESSIONS', '').split(',') if s]
+ACCOUNT_MAX_CALLS = int(os.getenv('ACCOUNT_MAX_CALLS', 0))  # Voice chats one account may be in at a time, 0 = no cap
+ACCOUNT_FAILURE_COOLDOWN = int(os.getenv('ACCOUNT_FAILURE_COOLDOWN', 300))  # Seconds an account rests after failing
+VOICE_CHAT_SSRC = 1234567890  # Audio source the account joins with, and names again when leaving
+
 # Owners who can control the bot
 OWNERS = [8508010746, 7450951468, 8255234078]
+OWNER_IDS = frozenset(OWNERS)
+
+# Download workers (yt-dlp runs in threads so the event loop stays free)
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 3))
+DOWNLOAD_QUEUE_LIMIT = int(os.getenv('DOWNLOAD_QUEUE_LIMIT', 10))  # Jobs allowed to wait for a worker
+
+# Scratch space for downloads in progress (point it at tmpfs, e.g. /dev/shm/music, for speed;
+# sharded processes each use their own subdirectory of an absolute path)
+SCRATCH_DIR = os.getenv('SCRATCH_DIR', 'downloads')
+SCRATCH_QUOTA_BYTES = int(os.getenv('SCRATCH_QUOTA_MB', 1024)) * 1024 * 1024
+SCRATCH_RESERVE_BYTES = int(os.getenv('SCRATCH_RESERVE_MB', 32)) * 1024 * 1024  # Assumed size until known
+SCRATCH_SWEEP_INTERVAL = int(os.getenv('SCRATCH_SWEEP_INTERVAL', 600))
+SCRATCH_ORPHAN_AGE = int(os.getenv('SCRATCH_ORPHAN_AGE', 600))  # Untracked entries older than this are removed
+SCRATCH_PREALLOCATE = os.getenv('SCRATCH_PREALLOCATE', '0') == '1'  # fallocate Telegram media before downloading
+
+# Telegram media downloads (large files are fetched as parallel parts)
+MEDIA_PART_SIZE = 512 * 1024  # Largest request_size Telethon sends in one GetFile (MAX_CHUNK_SIZE)
+MEDIA_DOWNLOAD_WORKERS = int(os.getenv('MEDIA_DOWNLOAD_WORKERS', 4))  # Concurrent part requests per file
+MEDIA_PARALLEL_MIN_BYTES = int(os.getenv('MEDIA_PARALLEL_MIN_MB', 8)) * 1024 * 1024
+MEDIA_PART_RETRIES = int(os.getenv('MEDIA_PART_RETRIES', 3))
+MEDIA_JOB_RATE_BYTES = int(os.getenv('MEDIA_JOB_RATE_MB', 0)) * 1024 * 1024  # Bandwidth cap per download, 0 = none
+
+# Audio cache (finished tracks are kept on disk and replayed without yt-dlp)
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', 'cache')
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_MB', 2048)) * 1024 * 1024
+
+# Audio profiles: yt-dlp format preference, target codec ('best' keeps whatever the
+# source uses) and the bitrate used only when a re-encode cannot be avoided
+AUDIO_PROFILES = {
+    'native': {'format': 'bestaudio[acodec=opus]/bestaudio[ext=m4a]/bestaudio/best', 'codec': 'best', 'bitrate': '128'},
+    'opus': {'format': 'bestaudio[acodec=opus]/bestaudio/best', 'codec': 'opus', 'bitrate': '128'},
+    'm4a': {'format': 'bestaudio[ext=m4a]/bestaudio/best', 'codec': 'm4a', 'bitrate': '128'},
+    'mp3-192': {'format': 'bestaudio/best', 'codec': 'mp3', 'bitrate': '192'},
+    'mp3-128': {'format': 'bestaudio/best', 'codec': 'mp3', 'bitrate': '128'},
+}
+AUDIO_PROFILE = os.getenv('AUDIO_PROFILE', 'native')
+if AUDIO_PROFILE not in AUDIO_PROFILES:
+    logger.error(f"❌ Unknown AUDIO_PROFILE {AUDIO_PROFILE!r}, using 'native'")
+    AUDIO_PROFILE = 'native'
+AUDIO_FORMAT = AUDIO_PROFILE  # Part of the audio cache key
+
+# Voice chats, queues and cache indexes live in SQLite; writes are batched off the event loop
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'state.db')
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', 0.5))  # Seconds between batched writes
+
+# Uploaded documents, resent by file reference instead of re-uploading
+UPLOAD_CACHE_PATH = os.getenv('UPLOAD_CACHE_PATH', 'file_refs.json')  # Old JSON file, imported once
+
+# Streaming mode (transcoder output is uploaded while it is still being produced)
+STREAM_MODE = os.getenv('STREAM_MODE', '0') == '1'
+STREAM_PREBUFFER_BYTES = int(os.getenv('STREAM_PREBUFFER_KB', 512)) * 1024
+STREAM_BUFFER_CHUNKS = int(os.getenv('STREAM_BUFFER_CHUNKS', 64))
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_PART_SIZE = 512 * 1024  # Telegram upload part size
+
+# Per-chat playback queues
+QUEUE_STATE_PATH = os.getenv('QUEUE_STATE_PATH', 'queues.json')  # Old JSON file, imported once
+QUEUE_PREFETCH = int(os.getenv('QUEUE_PREFETCH', 2))  # Upcoming tracks downloaded ahead of time (not in STREAM_MODE)
+QUEUE_DEFAULT_DURATION = int(os.getenv('QUEUE_DEFAULT_DURATION', 180))  # Seconds, when a track has no duration
+QUEUE_LIST_LIMIT = 20
+
+# Playlists and searches are resolved lazily, a batch at a time, as playback reaches them
+PLAYLIST_BATCH = int(os.getenv('PLAYLIST_BATCH', 10))  # Entries resolved per batch
+PLAYLIST_WINDOW = int(os.getenv('PLAYLIST_WINDOW', 5))  # Resolve more once this few tracks are left ahead
+PLAYLIST_MAX_ENTRIES = int(os.getenv('PLAYLIST_MAX_ENTRIES', 200))  # Cap for Mix/Radio lists, which never end on their own
+PLAYLIST_RE = re.compile(r'[?&]list=|/playlist\b')
+MIX_LIST_RE = re.compile(r'[?&]list=RD')
+
+# Voice chat lookups (filled from updates, RPC results cached for a short time)
+GROUP_CALL_TTL = int(os.getenv('GROUP_CALL_TTL', 30))
+GROUP_CALL_UPDATE_TTL = int(os.getenv('GROUP_CALL_UPDATE_TTL', 3600))
+
+# Resolved @usernames, t.me links and invite hashes
+ENTITY_CACHE_PATH = os.getenv('ENTITY_CACHE_PATH', 'entities.json')  # Old JSON file, imported once
+ENTITY_CACHE_TTL = int(os.getenv('ENTITY_CACHE_TTL', 86400))
+ENTITY_NEGATIVE_TTL = int(os.getenv('ENTITY_NEGATIVE_TTL', 600))
+
+# Outbound messages (per-chat rate limit, status messages edited in place)
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', 0.5))  # Messages per second per chat
+OUTBOX_CHAT_BURST = int(os.getenv('OUTBOX_CHAT_BURST', 3))
+STATUS_EDIT_INTERVAL = float(os.getenv('STATUS_EDIT_INTERVAL', 2.0))  # Seconds between status edits
+
+# Sharding (WORKERS > 0 runs a supervisor that routes chats to that many worker processes)
+WORKERS = int(os.getenv('WORKERS', 0))
+SHARD_DIR = os.getenv('SHARD_DIR', 'shards')  # Each worker keeps its sessions, caches and queues in SHARD_DIR/<n>
+WORKER_USER_SESSIONS = [s for s in os.getenv('WORKER_USER_SESSIONS', '').split(',') if s]  # One account per worker, required when WORKERS > 1
+WORKER_STATUS_INTERVAL = float(os.getenv('WORKER_STATUS_INTERVAL', 5))
+WORKER_RESTART_DELAY = float(os.getenv('WORKER_RESTART_DELAY', 5))
+WORKER_CONFIG_ERROR = 78  # Exit code of a worker that cannot start as configured (EX_CONFIG), not restarted
+
+# ================= LAZY IMPORTS =================
+# yt-dlp and its extractors take a noticeable part of startup, so they are
+# imported in the background (or by the first download) instead of up front
+yt_dlp = None
+YT_DLP_LOCK = threading.Lock()
+
+
+def load_yt_dlp():
+    """Import yt_dlp and its extractors once, from any thread"""
+    global yt_dlp
+    with YT_DLP_LOCK:
+        if yt_dlp is None:
+            started = time.perf_counter()
+            import yt_dlp
+            yt_dlp.extractor.gen_extractor_classes()
+            logger.info(f"⏱️ yt-dlp loaded in {time.perf_counter() - started:.2f}s")
+    return yt_dlp
 
 # ================= FLASK APP =================
 app = Flask(__name__)
+music_bot = None  # Set by run_bot, read by the Flask routes
+supervisor = None  # Set by run_supervisor instead when WORKERS > 0
+
+# ================= METRICS =================
+class Metrics:
+    """Minimal thread-safe registry rendered in Prometheus text format"""
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+    
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+    
+    def render(self, gauges=(), extra=()):
+        """Text exposition of all counters, histograms and the given (name, labels, value) gauges,
+        with extra (label, value) pairs added to every sample"""
+        extra = list(extra)
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{self._labels(labels, extra)} {value}")
+            for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                for bound, bucket_count in zip(self.BUCKETS, buckets):
+                    lines.append(f"{name}_bucket{self._labels(labels, extra + [('le', bound)])} {bucket_count}")
+                lines.append(f"{name}_bucket{self._labels(labels, extra + [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{self._labels(labels, extra)} {total}")
+                lines.append(f"{name}_count{self._labels(labels, extra)} {count}")
+        for name, labels, value in gauges:
+            lines.append(f"{name}{self._labels(sorted(labels.items()), extra)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def timed(stage):
+    """Decorator: record an async method's duration as a /play stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metrics.observe('bot_play_stage_seconds', time.perf_counter() - started, stage=stage)
+        return wrapper
+    return decorator
+
+
+def merge_exposition(texts):
+    """Join several render() outputs so each metric's samples stay together"""
+    families = {}  # metric name -> sample lines, in first-seen order
+    for text in texts:
+        for line in text.splitlines():
+            if line:
+                families.setdefault(line.split('{', 1)[0].split(' ', 1)[0], []).append(line)
+    return ''.join(line + '\n' for lines in families.values() for line in lines)
+
+
+def directory_size(path):
+    total = 0
+    try:
+        for entry in os.scandir(path):
+            if entry.is_file(follow_symlinks=False):
+                total += entry.stat().st_size
+            elif entry.is_dir(follow_symlinks=False):
+                total += directory_size(entry.path)
+    except FileNotFoundError:
+        pass
+    return total
+
+# ================= AUDIO PROFILES =================
+# yt-dlp acodec prefix for each target codec, to tell a remux from a re-encode
+CODEC_PREFIXES = {'opus': 'opus', 'm4a': 'mp4a', 'aac': 'mp4a', 'mp3': 'mp3', 'vorbis': 'vorbis'}
+
+
+def needs_reencode(codec, acodec):
+    """True if turning a source with acodec into codec means decoding and encoding"""
+    if codec == 'best':
+        return False
+    return not (acodec or '').startswith(CODEC_PREFIXES.get(codec, codec))
+
+
+def stream_output_args(profile, acodec):
+    """ffmpeg output args and file extension for piping a source in profile"""
+    codec = profile['codec']
+    if codec == 'best':
+        # Keep opus/aac as they are, anything else becomes mp3
+        codec = 'opus' if (acodec or '').startswith('opus') else 'm4a' if (acodec or '').startswith('mp4a') else 'mp3'
+    
+    encoder, container, ext = {
+        'opus': ('libopus', 'ogg', '.ogg'),
+        'm4a': ('aac', 'adts', '.aac'),  # mp4 cannot be written to a pipe
+        'mp3': ('libmp3lame', 'mp3', '.mp3'),
+    }[codec]
+    if needs_reencode(codec, acodec):
+        return ['-codec:a', encoder, '-b:a', f"{profile['bitrate']}k", '-f', container], ext
+    return ['-codec:a', 'copy', '-f', container], ext
+
+
+def children_cpu_seconds():
+    """CPU used by finished child processes (ffmpeg) so far"""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+# ================= DOWNLOAD EXECUTOR =================
+class DownloadQueueFull(Exception):
+    """Raised when every worker is busy and the wait queue is full"""
+
+
+class DownloadJob:
+    """A single download running (or waiting) in the executor"""
+    def __init__(self, key):
+        self.key = key
+        self.cancel_event = threading.Event()
+        self.future = None
+    
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+    
+    def cancel(self):
+        """Cancel the job - waiting jobs never start, running jobs stop at the next progress hook"""
+        self.cancel_event.set()
+        if self.future:
+            self.future.cancel()
+
+
+class DownloadExecutor:
+    """Bounded thread pool for blocking downloads with per-key cancellation"""
+    def __init__(self, workers=DOWNLOAD_WORKERS, queue_limit=DOWNLOAD_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download')
+        self.jobs = {}  # key -> set of DownloadJob
+        self.pending = 0
+    
+    @property
+    def waiting(self):
+        """Number of jobs queued behind busy workers"""
+        return max(0, self.pending - self.workers)
+    
+    async def run(self, key, func, *args):
+        """Run func(job, *args) in a worker thread and await its result"""
+        if self.pending >= self.workers + self.queue_limit:
+            raise DownloadQueueFull(
+                f"Download queue is full ({self.waiting} waiting), please try again shortly"
+            )
+        
+        loop = asyncio.get_running_loop()
+        job = DownloadJob(key)
+        job.future = self.pool.submit(func, job, *args)
+        self.jobs.setdefault(key, set()).add(job)
+        self.pending += 1
+        
+        # The slot is held until the thread is done, not just until the caller stops waiting
+        def release(future):
+            try:
+                loop.call_soon_threadsafe(self._release, job)
+            except RuntimeError:
+                pass  # Event loop already closed
+        job.future.add_done_callback(release)
+        
+        try:
+            return await asyncio.wrap_future(job.future)
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+    
+    def _release(self, job):
+        self.pending -= 1
+        jobs = self.jobs.get(job.key)
+        if jobs:
+            jobs.discard(job)
+            if not jobs:
+                del self.jobs[job.key]
+    
+    def cancel(self, key):
+        """Cancel all jobs for a key, returns how many were cancelled"""
+        jobs = self.jobs.get(key, ())
+        for job in jobs:
+            job.cancel()
+        return len(jobs)
+    
+    def shutdown(self):
+        for jobs in self.jobs.values():
+            for job in jobs:
+                job.cancel()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key into one shared task, cancelled once nobody waits for it"""
+    def __init__(self):
+        self.flights = {}  # key -> task
+        self.waiters = {}  # key -> callers awaiting the task
+    
+    async def run(self, key, factory):
+        """Await factory() - or the task already running for key"""
+        task = self.flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.flights[key] = task
+            self.waiters[key] = 0
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            logger.info(f"🔗 Joining in-flight download: {key}")
+        
+        self.waiters[key] += 1
+        try:
+            # Shielded so one waiter giving up does not cancel the others
+            return await asyncio.shield(task)
+        finally:
+            self._leave(key, task)
+    
+    def _leave(self, key, task):
+        if self.flights.get(key) is not task:
+            return
+        self.waiters[key] -= 1
+        if not self.waiters[key] and not task.done():
+            # The last waiter gave up; later callers start a fresh flight
+            del self.flights[key]
+            del self.waiters[key]
+            task.cancel()
+    
+    def _done(self, key, task):
+        if self.flights.get(key) is task:
+            del self.flights[key]
+            del self.waiters[key]
+        if not task.cancelled():
+            task.exception()  # Mark as retrieved when every waiter has gone
+
+# ================= SCRATCH STORE =================
+class ScratchFull(DownloadQueueFull):
+    """Raised when a download would push the scratch space over its quota"""
+
+
+class ScratchJob:
+    """A job's private scratch directory, deleted when the job is released"""
+    def __init__(self, path, reserved):
+        self.path = path
+        self.reserved = reserved  # Bytes counted against the quota
+
+
+class ScratchStore:
+    """Scratch space for downloads: one directory per job, quota admission and orphan sweeps"""
+    def __init__(self, root=SCRATCH_DIR, quota=SCRATCH_QUOTA_BYTES):
+        self.root = root
+        self.quota = quota
+        self.jobs = {}  # path -> ScratchJob
+        self.rejected = 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        # No job is live yet, so anything left over is from a crash
+        self.sweep(max_age=0)
+    
+    @property
+    def reserved(self):
+        with self.lock:
+            return sum(job.reserved for job in self.jobs.values())
+    
+    def _admit(self, extra):
+        used = sum(job.reserved for job in self.jobs.values())
+        if used + extra > self.quota:
+            self.rejected += 1
+            raise ScratchFull(f"Download space is full ({used / 1048576:.0f} MB in use), try again shortly")
+    
+    def open(self, expected=SCRATCH_RESERVE_BYTES):
+        """Admit a new job expecting that many bytes, raises ScratchFull over quota"""
+        with self.lock:
+            self._admit(expected)
+            path = os.path.join(self.root, f"job-{int(time.time())}-{random.getrandbits(32):08x}")
+            os.makedirs(path)
+            job = self.jobs[path] = ScratchJob(path, expected)
+        return job
+    
+    def reserve(self, job, expected):
+        """Resize job's reservation once its real size is known"""
+        with self.lock:
+            if expected > job.reserved:
+                self._admit(expected - job.reserved)
+            job.reserved = expected
+    
+    def release(self, job):
+        """Give back the job's reservation and delete its directory"""
+        with self.lock:
+            del self.jobs[job.path]
+        shutil.rmtree(job.path, ignore_errors=True)
+    
+    @contextmanager
+    def job(self, expected=SCRATCH_RESERVE_BYTES):
+        """Scratch job for the duration of a with block, cleaned up however it exits"""
+        job = self.open(expected)
+        try:
+            yield job
+        finally:
+            self.release(job)
+    
+    def sweep(self, max_age=SCRATCH_ORPHAN_AGE):
+        """Delete job directories no live job owns (crashed or abandoned downloads)"""
+        with self.lock:
+            live = set(self.jobs)
+        now = time.time()
+        removed = 0
+        for entry in os.scandir(self.root):
+            # SCRATCH_DIR may be shared (/dev/shm, /tmp), so only our own job-* entries are touched
+            if entry.path in live or not entry.name.startswith('job-'):
+                continue
+            try:
+                if now - entry.stat(follow_symlinks=False).st_mtime < max_age:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        if removed:
+            logger.info(f"🧹 Removed {removed} orphaned scratch entries")
+        return removed
+    
+    @staticmethod
+    def preallocate(path, size):
+        """Claim size bytes for path up front, so a full tmpfs fails before the download"""
+        with open(path, 'wb') as f:
+            os.posix_fallocate(f.fileno(), 0, size)
+
+# ================= STATE STORE =================
+class StateStore:
+    """SQLite key/value store (WAL) for state that must survive restarts; writes are coalesced
+    and committed in batches by a background thread"""
+    def __init__(self, path=STATE_DB_PATH, flush_interval=STATE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.pending = {}  # (namespace, key) -> JSON text, or None to delete
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')  # A crash may lose the last batch, never corrupts
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS state '
+            '(ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (ns, key)) WITHOUT ROWID'
+        )
+        self.db.commit()
+        self.writer = threading.Thread(target=self.write_loop, name='state-writer', daemon=True)
+        self.writer.start()
+    
+    def load(self, ns):
+        """Everything stored under namespace ns as {key: value}"""
+        with self.db_lock:
+            rows = self.db.execute('SELECT key, value FROM state WHERE ns = ?', (ns,)).fetchall()
+        values = {}
+        for key, text in rows:
+            try:
+                values[key] = json.loads(text)
+            except ValueError:
+                logger.warning(f"State {ns}/{key} unreadable, dropping")
+                self.delete(ns, key)
+        return values
+    
+    def put(self, ns, key, value):
+        text = json.dumps(value)
+        with self.lock:
+            self.pending[(ns, str(key))] = text
+    
+    def delete(self, ns, key):
+        with self.lock:
+            self.pending[(ns, str(key))] = None
+    
+    def flush(self):
+        """Commit everything pending in one transaction (later writes to a key replace earlier ones)"""
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        started = time.perf_counter()
+        try:
+            with self.db_lock, self.db:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+                    [(ns, key, text) for (ns, key), text in batch.items() if text is not None]
+                )
+                self.db.executemany(
+                    'DELETE FROM state WHERE ns = ? AND key = ?',
+                    [(ns, key) for (ns, key), text in batch.items() if text is None]
+                )
+        except Exception:
+            # Keep the batch for the next attempt unless newer writes replaced it
+            with self.lock:
+                self.pending = {**batch, **self.pending}
+            raise
+        metrics.observe('bot_state_flush_seconds', time.perf_counter() - started)
+    
+    def write_loop(self):
+        while not self.closed:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"State store write error: {e}")
+    
+    def close(self):
+        """Stop the writer and commit what is left"""
+        if self.closed:
+            return
+        self.closed = True
+        self.wake.set()
+        self.writer.join()
+        self.flush()
+        self.db.close()
+    
+    def import_json(self, ns, path):
+        """One-time import of a JSON state file written before the state store existed"""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Old state file {path} unreadable, not imported: {e}")
+            return
+        for key, value in data.items():
+            self.put(ns, key, value)
+        self.flush()
+        os.replace(path, path + '.imported')
+        logger.info(f"📦 Imported {len(data)} {ns} entries from {path}")
+
+# ================= AUDIO CACHE =================
+YOUTUBE_ID_RE = re.compile(
+    r'(?:youtube\.com/(?:watch\?(?:\S*?&)?v=|shorts/|embed/|live/)|youtu\.be/)([\w-]{11})'
+)
+
+
+class AudioCache:
+    """Persistent on-disk audio cache keyed by extractor, video ID and format"""
+    def __init__(self, store, directory=AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_MAX_BYTES):
+        self.store = store
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = {}  # key -> {path, size, last_access, hits}
+        self.in_use = {}  # path -> number of senders currently reading it
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self.load()
+    
+    @staticmethod
+    def make_key(extractor, video_id, fmt):
+        return f"{extractor.lower()}-{video_id}-{fmt}"
+    
+    @classmethod
+    def key_for_url(cls, url, fmt):
+        """Cache key for URLs whose video ID can be read without yt-dlp"""
+        match = YOUTUBE_ID_RE.search(url)
+        if match:
+            return cls.make_key('youtube', match.group(1), fmt)
+        return None
+    
+    @property
+    def total_bytes(self):
+        with self.lock:
+            return sum(entry['size'] for entry in self.entries.values())
+    
+    def load(self):
+        """Load the index and drop entries whose files are missing or truncated"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.store.import_json('audio', os.path.join(self.directory, 'index.json'))
+        
+        for key, entry in self.store.load('audio').items():
+            path = entry.get('path', '')
+            if os.path.isfile(path) and os.path.getsize(path) == entry.get('size'):
+                self.entries[key] = entry
+            else:
+                logger.warning(f"Audio cache entry {key} failed integrity check, dropping")
+                self.store.delete('audio', key)
+        
+        # Remove files the index does not know about (crashed downloads etc.),
+        # keeping the backup of an imported index.json
+        known = {os.path.abspath(entry['path']) for entry in self.entries.values()}
+        for name in os.listdir(self.directory):
+            path = os.path.abspath(os.path.join(self.directory, name))
+            if path not in known and os.path.isfile(path) and not name.endswith('.imported'):
+                os.remove(path)
+        
+        self.evict()
+        logger.info(f"🗄️ Audio cache: {len(self.entries)} tracks, {self.total_bytes / 1048576:.1f} MB")
+    
+    def get(self, key):
+        """Return the cached file for key, or None on a miss"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and not os.path.isfile(entry['path']):
+                del self.entries[key]
+                self.store.delete('audio', key)
+                entry = None
+            if not entry:
+                self.misses += 1
+                return None
+            
+            entry['last_access'] = time.time()
+            entry['hits'] += 1
+            self.hits += 1
+            self.store.put('audio', key, entry)
+            return entry['path']
+    
+    def put(self, key, file_path, info=None):
+        """Move a finished download into the cache and return its new path"""
+        ext = os.path.splitext(file_path)[1]
+        path = os.path.join(self.directory, key + ext)
+        staged = file_path
+        if os.stat(file_path).st_dev != os.stat(self.directory).st_dev:
+            # Scratch space on another filesystem (tmpfs): copy next to the cache
+            # first so the replace below stays atomic
+            staged = path + '.part'
+            shutil.copyfile(file_path, staged)
+            os.remove(file_path)
+        with self.lock:
+            os.replace(staged, path)
+            self.entries[key] = {
+                'path': path,
+                'size': os.path.getsize(path),
+                'last_access': time.time(),
+                'hits': 0,
+                'title': (info or {}).get('title'),
+                'duration': (info or {}).get('duration'),
+            }
+            self.store.put('audio', key, self.entries[key])
+            self.evict(keep=key)
+        return path
+    
+    def evict(self, keep=None):
+        """Delete least recently used tracks until the cache fits the byte budget"""
+        with self.lock:
+            total = self.total_bytes
+            by_age = sorted(self.entries.items(), key=lambda item: item[1]['last_access'])
+            for key, entry in by_age:
+                if total <= self.max_bytes:
+                    break
+                if key == keep or self.in_use.get(entry['path']):
+                    continue
+                try:
+                    os.remove(entry['path'])
+                except FileNotFoundError:
+                    pass
+                total -= entry['size']
+                del self.entries[key]
+                self.store.delete('audio', key)
+                logger.info(f"🗑️ Evicted {key} from audio cache")
+    
+    def key_for_path(self, path):
+        with self.lock:
+            for key, entry in self.entries.items():
+                if entry['path'] == path:
+                    return key
+        return None
+    
+    @contextmanager
+    def using(self, path):
+        """Protect a cached file from eviction while it is being sent"""
+        if path is None:
+            yield None
+            return
+        with self.lock:
+            self.in_use[path] = self.in_use.get(path, 0) + 1
+        try:
+            yield path
+        finally:
+            with self.lock:
+                self.in_use[path] -= 1
+                if not self.in_use[path]:
+                    del self.in_use[path]
+
+# ================= UPLOAD CACHE =================
+class UploadCache:
+    """Remembers uploaded documents so the same audio can be resent by reference"""
+    def __init__(self, store, legacy_path=UPLOAD_CACHE_PATH):
+        self.store = store
+        self.store.import_json('uploads', legacy_path)
+        self.entries = self.store.load('uploads')  # key -> {id, access_hash, file_reference, chat_id, msg_id}
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        """InputDocument for an earlier upload of key, or None"""
+        entry = self.entries.get(key)
+        if not entry:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return types.InputDocument(
+            id=entry['id'],
+            access_hash=entry['access_hash'],
+            file_reference=bytes.fromhex(entry['file_reference'])
+        )
+    
+    def remember(self, key, message, info=None):
+        """Record the document carried by message (also where to refresh it from), with the
+        track's title and duration so it can be replayed without the audio file"""
+        document = message.document if message else None
+        if not document:
+            return
+        info = info or self.entries.get(key) or {}
+        self.entries[key] = {
+            'id': document.id,
+            'access_hash': document.access_hash,
+            'file_reference': document.file_reference.hex(),
+            'chat_id': message.chat_id,
+            'msg_id': message.id,
+            'title': info.get('title'),
+            'duration': info.get('duration'),
+        }
+        self.store.put('uploads', key, self.entries[key])
+    
+    def forget(self, key):
+        if self.entries.pop(key, None):
+            self.store.delete('uploads', key)
+
+# ================= AUDIO STREAM =================
+class AudioStream:
+    """Bounded async chunk buffer between an audio producer and its sink"""
+    def __init__(self, prebuffer=STREAM_PREBUFFER_BYTES, max_chunks=STREAM_BUFFER_CHUNKS):
+        self.queue = asyncio.Queue(maxsize=max_chunks)
+        self.prebuffer = prebuffer
+        self.buffered = 0
+        self.ready = asyncio.Event()  # Set once the prebuffer is full or the stream ended
+        self.error = None
+        self.key = None
+        self.name = 'audio.mp3'
+        self.title = None
+        self.duration = None
+    
+    @property
+    def failed(self):
+        return self.error is not None and self.buffered == 0
+    
+    async def put(self, chunk):
+        await self.queue.put(chunk)
+        self.buffered += len(chunk)
+        if self.buffered >= self.prebuffer or self.queue.full():
+            self.ready.set()
+    
+    async def close(self, error=None):
+        self.error = error
+        await self.queue.put(None)
+        self.ready.set()
+    
+    async def __aiter__(self):
+        while True:
+            chunk = await self.queue.get()
+            if chunk is None:
+                if self.error:
+                    raise self.error
+                return
+            yield chunk
+
+# ================= PLAYBACK QUEUE =================
+class ChatQueue:
+    """Upcoming tracks and playback state for one chat"""
+    def __init__(self, chat_id, entries=None, current=None, paused=False):
+        self.chat_id = chat_id
+        self.entries = entries or []
+        self.current = current
+        self.paused = paused
+        self.skip_requested = False
+        self.task = None  # Scheduler task
+        self.prefetch = {}  # url -> download task
+        self.interrupt = asyncio.Event()  # Set by pause, resume and skip
+    
+    def to_dict(self):
+        return {'entries': self.entries, 'current': self.current, 'paused': self.paused}
+    
+    def pause(self):
+        self.paused = True
+        self.interrupt.set()
+    
+    def resume(self):
+        self.paused = False
+        self.interrupt.set()
+    
+    def skip(self):
+        """End the current track; the next one starts unpaused"""
+        self.skip_requested = True
+        self.paused = False
+        self.interrupt.set()
+    
+    def remove(self, position):
+        """Remove the entry at 1-based position, returns it or None"""
+        if not 1 <= position <= len(self.entries):
+            return None
+        entry = self.entries.pop(position - 1)
+        self.cancel_prefetch([entry])
+        return entry
+    
+    def clear(self):
+        """Drop all upcoming entries, returns how many there were"""
+        count = len(self.entries)
+        self.cancel_prefetch(self.entries)
+        self.entries = []
+        return count
+    
+    def cancel_prefetch(self, entries):
+        wanted = {entry.get('url') for entry in self.entries if entry not in entries}
+        for entry in entries:
+            url = entry.get('url')
+            task = self.prefetch.get(url)
+            if task and url not in wanted:
+                task.cancel()
+                del self.prefetch[url]
+    
+    async def wait(self, duration):
+        """Sleep for the track duration, stopping the clock while paused"""
+        loop = asyncio.get_running_loop()
+        remaining = duration
+        while remaining > 0 and not self.skip_requested:
+            if self.paused:
+                # Only /resume or /skip moves a paused track on
+                self.interrupt.clear()
+                await self.interrupt.wait()
+                continue
+            self.interrupt.clear()
+            started = loop.time()
+            try:
+                await asyncio.wait_for(self.interrupt.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+            remaining -= loop.time() - started
+
+
+class QueueStore:
+    """All chat queues, persisted to the state store so they survive restarts"""
+    def __init__(self, store, legacy_path=QUEUE_STATE_PATH):
+        self.store = store
+        self.queues = {}
+        self.stored = set()  # Chats with a queue in the store
+        self.store.import_json('queues', legacy_path)
+        self.load()
+    
+    def get(self, chat_id):
+        if chat_id not in self.queues:
+            self.queues[chat_id] = ChatQueue(chat_id)
+        return self.queues[chat_id]
+    
+    def pending(self):
+        """Chats with something left to play"""
+        return [chat_id for chat_id, queue in self.queues.items() if queue.current or queue.entries]
+    
+    def load(self):
+        for chat_id, state in self.store.load('queues').items():
+            self.queues[int(chat_id)] = ChatQueue(int(chat_id), **state)
+            self.stored.add(int(chat_id))
+    
+    def save(self, chat_id=None):
+        """Hand chat_id's queue, which just changed, to the store (every queue when None)"""
+        for chat_id in list(self.queues) if chat_id is None else [chat_id]:
+            queue = self.queues.get(chat_id)
+            if queue and (queue.current or queue.entries):
+                self.store.put('queues', chat_id, queue.to_dict())
+                self.stored.add(chat_id)
+            elif chat_id in self.stored:
+                self.stored.discard(chat_id)
+                self.store.delete('queues', chat_id)
+
+# ================= GROUP CALL INDEX =================
+class GroupCallIndex:
+    """Active voice chat per chat, fed by user_client updates with a TTL cache for RPC lookups"""
+    def __init__(self, ttl=GROUP_CALL_TTL, update_ttl=GROUP_CALL_UPDATE_TTL):
+        self.ttl = ttl
+        self.update_ttl = update_ttl
+        self.calls = {}  # bare chat id -> (InputGroupCall or None, expires_at)
+        self.chats_by_call = {}  # call id -> bare chat id
+        self.participants = {}  # call id -> participant count
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def bare_id(chat_id):
+        return utils.resolve_id(chat_id)[0]
+    
+    def get(self, chat_id):
+        """Returns (known, call) - known is False when an RPC lookup is needed"""
+        entry = self.calls.get(self.bare_id(chat_id))
+        if entry and entry[1] > time.time():
+            self.hits += 1
+            return True, entry[0]
+        self.misses += 1
+        return False, None
+    
+    def set(self, chat_id, call, ttl=None):
+        bare_id = self.bare_id(chat_id)
+        self.calls[bare_id] = (call, time.time() + (ttl or self.ttl))
+        if call:
+            self.chats_by_call[call.id] = bare_id
+    
+    def on_group_call(self, update):
+        """UpdateGroupCall: a voice chat started, changed or ended"""
+        call = update.call
+        if isinstance(call, types.GroupCallDiscarded):
+            self.calls[update.chat_id] = (None, time.time() + self.update_ttl)
+            self.chats_by_call.pop(call.id, None)
+            self.participants.pop(call.id, None)
+            return
+        
+        input_call = types.InputGroupCall(id=call.id, access_hash=call.access_hash)
+        self.calls[update.chat_id] = (input_call, time.time() + self.update_ttl)
+        self.chats_by_call[call.id] = update.chat_id
+        self.participants[call.id] = call.participants_count
+    
+    def on_participants(self, update):
+        """UpdateGroupCallParticipants: returns True if our own account left the call"""
+        self_left = False
+        count = self.participants.get(update.call.id, 0)
+        for participant in update.participants:
+            if participant.left:
+                count -= 1
+                self_left = self_left or bool(participant.is_self)
+            elif participant.just_joined:
+                count += 1
+        self.participants[update.call.id] = max(0, count)
+        return self_left
+
+# ================= ENTITY CACHE =================
+INVITE_LINK_RE = re.compile(r't\.me/(?:joinchat/|\+)([\w-]+)')
+PUBLIC_LINK_RE = re.compile(r't\.me/@?(?!(?:c|s|joinchat)/)(\w+)(?=[/?#\s]|$)')  # Not private /c/ message links
+USERNAME_RE = re.compile(r'^@(\w+)$')
+
+
+def parse_chat_target(target):
+    """Split @username / t.me link / invite link into ('username' | 'invite', value)"""
+    match = INVITE_LINK_RE.search(target)
+    if match:
+        return 'invite', match.group(1)
+    match = PUBLIC_LINK_RE.search(target) or USERNAME_RE.match(target)
+    if match:
+        return 'username', match.group(1).lower()
+    return None
+
+
+class EntityCache:
+    """Resolved chats by username, invite hash or ID, with TTL and negative caching"""
+    def __init__(self, store, legacy_path=ENTITY_CACHE_PATH, ttl=ENTITY_CACHE_TTL, negative_ttl=ENTITY_NEGATIVE_TTL):
+        self.store = store
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.store.import_json('entities', legacy_path)
+        self.entries = self.store.load('entities')  # key -> {id, title, expires} (id is None for negative entries)
+        self.hits = 0
+        self.misses = 0
+        self.prune()
+    
+    def prune(self):
+        """Drop expired entries"""
+        now = time.time()
+        for key in [k for k, v in self.entries.items() if v['expires'] <= now]:
+            del self.entries[key]
+            self.store.delete('entities', key)
+    
+    def get(self, key):
+        """Returns (known, entry) - entry is None for a cached negative result"""
+        entry = self.entries.get(key)
+        if entry and entry['expires'] > time.time():
+            self.hits += 1
+            return True, entry if entry['id'] is not None else None
+        self.misses += 1
+        return False, None
+    
+    def put(self, key, entity):
+        """Cache entity under key (and under its ID and username)"""
+        entry = {
+            'id': utils.get_peer_id(entity),
+            'title': getattr(entity, 'title', None) or utils.get_display_name(entity),
+            'expires': time.time() + self.ttl,
+        }
+        keys = {key, f"id:{entry['id']}"}
+        if getattr(entity, 'username', None):
+            keys.add(f"username:{entity.username.lower()}")
+        for k in keys:
+            self.entries[k] = entry
+            self.store.put('entities', k, entry)
+        return entry
+    
+    def put_missing(self, key):
+        self.entries[key] = {'id': None, 'title': None, 'expires': time.time() + self.negative_ttl}
+        self.store.put('entities', key, self.entries[key])
+
+# ================= OUTBOX =================
+class TokenBucket:
+    """Simple token bucket - acquire() waits until enough tokens are available"""
+    def __init__(self, rate=OUTBOX_CHAT_RATE, capacity=OUTBOX_CHAT_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    async def acquire(self, amount=1):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class Outbox:
+    """Rate-aware outbound messages: per-chat token buckets and FloodWait rescheduling"""
+    def __init__(self):
+        self.client = None  # bot_client, set once it has started
+        self.buckets = {}  # chat_id -> TokenBucket
+        self.flood_wait_seconds = 0
+    
+    async def call(self, chat_id, func, *args, retry_flood=True, **kwargs):
+        """Run a send/edit for chat_id once the chat's bucket allows it"""
+        if chat_id not in self.buckets:
+            self.buckets[chat_id] = TokenBucket()
+        while True:
+            await self.buckets[chat_id].acquire()
+            try:
+                return await func(*args, **kwargs)
+            except errors.FloodWaitError as e:
+                self.flood_wait_seconds += e.seconds
+                logger.warning(f"⏳ FloodWait {e.seconds}s for chat {chat_id}")
+                if not retry_flood:
+                    raise
+                await asyncio.sleep(e.seconds + 1)
+    
+    async def send(self, chat_id, text, **kwargs):
+        return await self.call(chat_id, self.client.send_message, chat_id, text, **kwargs)
+    
+    async def send_file(self, chat_id, file, **kwargs):
+        return await self.call(chat_id, self.client.send_file, chat_id, file, **kwargs)
+    
+    async def edit(self, chat_id, message_id, text):
+        return await self.call(chat_id, self.client.edit_message, chat_id, message_id, text, retry_flood=False)
+    
+    def status(self, chat_id, reply_to=None, message_id=None):
+        return StatusMessage(self, chat_id, reply_to, message_id)
+
+
+class StatusMessage:
+    """One status message per request, edited in place with edits coalesced"""
+    def __init__(self, outbox, chat_id, reply_to=None, message_id=None):
+        self.outbox = outbox
+        self.chat_id = chat_id
+        self.reply_to = reply_to
+        self.message_id = message_id
+        self.text = None
+        self.pending = None
+        # An existing message was just sent or edited, so start inside the coalescing window
+        self.last_edit = time.monotonic() if message_id else 0.0
+        self.task = None
+        self.wake = asyncio.Event()  # Set by flush() to skip the coalescing delay
+    
+    async def update(self, text):
+        """Show text - sent right away the first time, later edits are coalesced"""
+        if self.message_id is None:
+            message = await self.outbox.send(self.chat_id, text, reply_to=self.reply_to)
+            self.message_id = message.id
+            self.text = text
+            self.last_edit = time.monotonic()
+            return
+        
+        self.pending = text
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._flush_later())
+    
+    async def flush(self):
+        """Put the latest text on screen now instead of after the coalescing delay"""
+        if self.task:
+            self.wake.set()
+            await self.task
+            self.wake.clear()
+    
+    async def _flush_later(self):
+        while self.pending is not None:
+            delay = self.last_edit + STATUS_EDIT_INTERVAL - time.monotonic()
+            if delay > 0 and not self.wake.is_set():
+                try:
+                    await asyncio.wait_for(self.wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            
+            text, self.pending = self.pending, None
+            if text == self.text:
+                continue
+            try:
+                await self.outbox.edit(self.chat_id, self.message_id, text)
+                self.text = text
+            except errors.FloodWaitError as e:
+                # Reschedule - a newer text queued meanwhile replaces this one
+                if self.pending is None:
+                    self.pending = text
+                await asyncio.sleep(e.seconds)
+                continue
+            except errors.MessageNotModifiedError:
+                self.text = text
+            except Exception as e:
+                logger.warning(f"Status edit failed in {self.chat_id}: {e}")
+            self.last_edit = time.monotonic()
+
+# ================= USER ACCOUNT POOL =================
+class UserAccount:
+    """One user session of the pool"""
+    def __init__(self, session):
+        self.session = session
+        self.client = None  # Connected on first use
+        self.chats = set()  # Chats whose voice chat this account is in
+        self.cooldown_until = 0.0
+        self.start_lock = asyncio.Lock()
+    
+    @property
+    def available(self):
+        if time.monotonic() < self.cooldown_until:
+            return False
+        return self.client is None or self.client.is_connected()
+    
+    def cool_down(self, seconds, reason):
+        self.cooldown_until = time.monotonic() + seconds
+        logger.warning(f"🧊 Account {self.session} resting for {seconds}s: {reason}")
+
+
+class AccountPool:
+    """User accounts that join voice chats: sticky per chat, otherwise the least-loaded healthy one"""
+    def __init__(self, sessions=None, max_calls=ACCOUNT_MAX_CALLS):
+        sessions = sessions or ['user_session'] + USER_SESSIONS
+        self.accounts = [UserAccount(session) for session in sessions]
+        self.max_calls = max_calls
+        self.assigned = {}  # chat_id -> UserAccount that last played there
+        self.on_start = None  # Called with each client once it is connected
+    
+    def by_session(self, session):
+        return next((account for account in self.accounts if account.session == session), None)
+    
+    def restore(self, chat_id, session):
+        """Record that session was in chat_id's voice chat before a restart, returns False if it is gone"""
+        account = self.by_session(session)
+        if account is None:
+            return False
+        account.chats.add(chat_id)
+        self.assigned[chat_id] = account
+        return True
+    
+    def adopt(self, client):
+        """The primary account, already started by initialize"""
+        self.accounts[0].client = client
+        if self.on_start:
+            self.on_start(client)
+    
+    def account_in(self, chat_id):
+        account = self.assigned.get(chat_id)
+        return account if account and chat_id in account.chats else None
+    
+    def pick(self, chat_id, exclude=()):
+        account = self.assigned.get(chat_id)
+        if account and account not in exclude and account.available:
+            return account
+        
+        candidates = [
+            a for a in self.accounts
+            if a not in exclude and a.available and (not self.max_calls or len(a.chats) < self.max_calls)
+        ]
+        if not candidates:
+            return None
+        # Fewest calls first; on a tie an account that is already connected wins
+        return min(candidates, key=lambda a: (len(a.chats), a.client is None))
+    
+    async def client_for(self, account):
+        """Connect account's session on first use (extra sessions must already be logged in)"""
+        async with account.start_lock:
+            if account.client is None:
+                client = TelegramClient(account.session, int(USER_API_ID), USER_API_HASH)
+                await client.connect()
+                if not await client.is_user_authorized():
+                    await client.disconnect()
+                    account.cool_down(ACCOUNT_FAILURE_COOLDOWN, "session is not logged in")
+                    raise ConnectionError(f"{account.session} is not logged in")
+                account.client = client
+                logger.info(f"✅ Account {account.session} connected")
+                if self.on_start:
+                    self.on_start(client)
+        return account.client
+    
+    async def join(self, chat_id, request):
+        """Send the join request from the chat's account, moving on to the next one if it is limited"""
+        tried = set()
+        chat_error = None  # Last error that was about this account in this chat
+        while True:
+            account = self.pick(chat_id, exclude=tried)
+            if account is None:
+                raise chat_error or RuntimeError("No user account available to join")
+            tried.add(account)
+            try:
+                client = await self.client_for(account)
+                result = await client(request)
+            except errors.FloodWaitError as e:
+                account.cool_down(e.seconds, "FloodWait")
+                continue
+            except (ConnectionError, errors.UnauthorizedError) as e:
+                account.cool_down(ACCOUNT_FAILURE_COOLDOWN, e)
+                continue
+            except (errors.BadRequestError, errors.ForbiddenError) as e:
+                # Not a member, banned, no permission...: another account may still get in
+                logger.info(f"Account {account.session} cannot join in {chat_id}: {e}")
+                chat_error = e
+                continue
+            
+            account.chats.add(chat_id)
+            self.assigned[chat_id] = account
+            return result
+    
+    async def call(self, chat_id, request):
+        """Send request from the account that is in chat_id's voice chat"""
+        account = self.account_in(chat_id)
+        if account is None:
+            raise RuntimeError("No user account is in this voice chat")
+        # Accounts restored from the state store connect on first use
+        client = await self.client_for(account)
+        try:
+            return await client(request)
+        except errors.FloodWaitError as e:
+            account.cool_down(e.seconds, "FloodWait")
+            raise
+    
+    def left(self, chat_id):
+        account = self.account_in(chat_id)
+        if account:
+            account.chats.discard(chat_id)
+    
+    def gauges(self):
+        return [
+            gauge
+            for account in self.accounts
+            for gauge in (
+                ('bot_account_calls', {'account': account.session}, len(account.chats)),
+                ('bot_account_available', {'account': account.session}, int(account.available)),
+            )
+        ]
 
 # ================= BOT CLASS =================
 class VoiceChatMusicBot:
-    def __init__(self):
+    def __init__(self, shard=None):
+        started = time.perf_counter()
+        self.state = 'starting'  # -> 'running' or 'failed', reported by /health
+        self.shard = shard  # Supervisor or ShardWorker when sharded, None in a single process
         self.bot_client = None  # Bot account (receives commands via token)
         self.user_client = None  # User account (plays music in VC via API ID/HASH)
+        # user_client plus USER_SESSIONS (or this worker's share of them), joins voice chats
+        self.accounts = AccountPool(['user_session'] + (USER_SESSIONS if shard is None else shard.user_sessions))
+        self.bot_username = ''
+        self.commands = {}
         self.active_calls = {}
+        self.store = StateStore(self.own_path(STATE_DB_PATH, directory=False))
+        self.downloads = DownloadExecutor()
+        self.scratch = ScratchStore(self.own_path(SCRATCH_DIR))
+        self.in_flight = SingleFlight()
+        self.audio_cache = AudioCache(self.store, self.own_path(AUDIO_CACHE_DIR))
+        self.upload_cache = UploadCache(self.store)
+        self.queues = QueueStore(self.store)
+        self.group_calls = GroupCallIndex()
+        self.entities = EntityCache(self.store)
+        self.outbox = Outbox()
+        self.loop_lag = 0.0
+        self.playlists = {}  # Placeholder token -> lazy entry iterator
+        self.expansions = {}  # Placeholder token -> task resolving its next batch
+        self.restore_calls()
+        self.startup = {'state_load': time.perf_counter() - started}  # Stage -> seconds
+    
+    def own_path(self, path, directory=True):
+        """path for this process; absolute paths (e.g. /dev/shm) are shared by every process of a
+        sharded bot, which would sweep each other's files, so each gets its own below them"""
+        if self.shard is None or not os.path.isabs(path):
+            return path  # Relative paths already live in each worker's SHARD_DIR/<n>
+        if directory:
+            return os.path.join(path, self.shard.name)
+        root, ext = os.path.splitext(path)
+        return f"{root}-{self.shard.name}{ext}"
+    
+    def restore_calls(self):
+        """Voice chats a pool account was in before the restart (checked against Telegram once connected)"""
+        for chat_id, state in self.store.load('calls').items():
+            if self.accounts.restore(int(chat_id), state['account']):
+                self.active_calls[int(chat_id)] = types.InputGroupCall(id=state['id'], access_hash=state['access_hash'])
+            else:
+                self.store.delete('calls', chat_id)
+        if self.active_calls:
+            logger.info(f"📞 Restored {len(self.active_calls)} voice chats from before the restart")
+    
+    def remember_call(self, chat_id, call):
+        self.active_calls[chat_id] = call
+        account = self.accounts.account_in(chat_id) or self.accounts.accounts[0]
+        self.store.put('calls', chat_id, {'id': call.id, 'access_hash': call.access_hash, 'account': account.session})
+    
+    def drop_call(self, chat_id):
+        """Forget chat_id's voice chat (the account left, was removed or the call ended)"""
+        self.active_calls.pop(chat_id, None)
+        self.accounts.left(chat_id)
+        self.store.delete('calls', chat_id)
+    
+    async def reconcile_calls(self):
+        """Drop restored voice chats that ended, or that the account is no longer in"""
+        started = time.perf_counter()
+        dropped = 0
+        for chat_id, call in list(self.active_calls.items()):
+            try:
+                result = await self.accounts.call(chat_id, functions.phone.GetGroupParticipantsRequest(
+                    call=call, ids=[types.InputPeerSelf()], sources=[], offset='', limit=1
+                ))
+                still_in = bool(result.participants)
+            except (errors.RPCError, RuntimeError, ConnectionError) as e:
+                logger.info(f"Voice chat of {chat_id} is gone: {e}")
+                still_in = False
+            except Exception as e:
+                logger.error(f"Voice chat check error in {chat_id}: {e}")
+                continue
+            if not still_in and self.active_calls.get(chat_id) is call:
+                self.drop_call(chat_id)
+                dropped += 1
+        metrics.observe('bot_state_reconcile_seconds', time.perf_counter() - started)
+        if dropped:
+            logger.info(f"📴 {dropped} restored voice chats had ended or been left")
+        
+    async def start_bot_client(self):
+        """Connect and log in the BOT account"""
+        started = time.perf_counter()
+        logger.info("Initializing BOT account (using Bot Token)...")
+        # Initialize BOT account using ONLY BOT_TOKEN
+        # We use Telegram's default bot API credentials
+        # Workers only send; commands reach them from the supervisor
+        self.bot_client = TelegramClient(
+            'bot_session', 2040, "b18441a1ff500e14f25e2e95ffd20eeb", receive_updates=self.shard is None
+        )
+        await self.bot_client.start(bot_token=BOT_TOKEN)
+        bot_me = await self.bot_client.get_me()
+        self.outbox.client = self.bot_client
+        self.bot_username = (bot_me.username or '').lower()
+        logger.info(f"✅ BOT account started: @{bot_me.username} (ID: {bot_me.id})")
+        self.startup['bot_client'] = time.perf_counter() - started
+        return bot_me
+    
+    async def start_user_client(self):
+        """Connect and log in the primary USER account"""
+        started = time.perf_counter()
+        logger.info("Initializing USER account (using API ID/HASH)...")
+        # Initialize USER account using USER'S OWN API ID/HASH
+        self.user_client = TelegramClient('user_session', int(USER_API_ID), USER_API_HASH)
         
+        # Start user client
+        if USER_PHONE:
+            await self.user_client.start(phone=USER_PHONE)
+        else:
+            await self.user_client.start()
+            
+        user_me = await self.user_client.get_me()
+        logger.info(f"✅ USER account started: @{user_me.username} (ID: {user_me.id})")
+        logger.info(f"✅ This user account will join voice chats to play music")
+        self.startup['user_client'] = time.perf_counter() - started
+        return user_me
+    
     async def initialize(self):
         """Initialize both bot and user clients"""
         try:
-            logger.info("Initializing BOT account (using Bot Token)...")
-            # Initialize BOT account using ONLY BOT_TOKEN
-            # We use Telegram's default bot API credentials
-            self.bot_client = TelegramClient('bot_session', 2040, "b18441a1ff500e14f25e2e95ffd20eeb")
-            await self.bot_client.start(bot_token=BOT_TOKEN)
-            bot_me = await self.bot_client.get_me()
-            logger.info(f"✅ BOT account started: @{bot_me.username} (ID: {bot_me.id})")
-            
-            logger.info("Initializing USER account (using API ID/HASH)...")
-            # Initialize USER account using USER'S OWN API ID/HASH
-            # Convert USER_API_ID to integer
             if not USER_API_ID or not USER_API_HASH:
                 logger.error("❌ USER_API_ID or USER_API_HASH is not set")
                 return False
-                
-            user_api_id_int = int(USER_API_ID)
-            self.user_client = TelegramClient('user_session', user_api_id_int, USER_API_HASH)
             
-            # Start user client
-            if USER_PHONE:
-                await self.user_client.start(phone=USER_PHONE)
-            else:
-                await self.user_client.start()
-                
-            user_me = await self.user_client.get_me()
-            logger.info(f"✅ USER account started: @{user_me.username} (ID: {user_me.id})")
-            logger.info(f"✅ This user account will join voice chats to play music")
+            # yt-dlp loads in a thread while both accounts connect and log in concurrently
+            asyncio.get_running_loop().run_in_executor(None, load_yt_dlp)
+            started = time.perf_counter()
+            bot_me, user_me = await asyncio.gather(self.start_bot_client(), self.start_user_client())
+            self.startup['clients'] = time.perf_counter() - started
             
             # Setup bot command handlers
+            started = time.perf_counter()
             self.setup_handlers()
+            self.accounts.on_start = self.setup_user_handlers
+            self.accounts.adopt(self.user_client)
+            if len(self.accounts.accounts) > 1:
+                logger.info(f"👥 {len(self.accounts.accounts) - 1} more user accounts start on first join")
+            
+            # Warm the entity cache in the background
+            asyncio.create_task(self.prewarm_entities())
+            asyncio.create_task(self.monitor_loop_lag())
+            asyncio.create_task(self.sweep_scratch())
+            asyncio.create_task(self.reconcile_calls())
+            
+            if self.shard:
+                self.shard.attach(self)
+            
+            # Pick up queues left over from before a restart (chats that moved to
+            # another worker since then are handed over to it)
+            for chat_id in self.queues.pending():
+                if self.owns(chat_id):
+                    self.ensure_scheduler(chat_id)
+                else:
+                    self.hand_off_queue(chat_id)
+            if self.queues.pending():
+                logger.info(f"▶️ Resumed {len(self.queues.pending())} chat queues")
+            
+            self.startup['handlers'] = time.perf_counter() - started
             
             logger.info("✅ Bot system fully initialized!")
             logger.info(f"🤖 Bot: @{bot_me.username} (receives commands)")
             logger.info(f"👤 User: @{user_me.username} (plays music in VC)")
+            self.log_startup()
             
+            self.state = 'running'
             return True
             
         except Exception as e:
             logger.error(f"❌ Initialization failed: {e}")
             traceback.print_exc()
+            self.state = 'failed'
             return False
     
-    def setup_handlers(self):
-        """Setup command handlers for the BOT"""
+    def log_startup(self):
+        stages = {'imports': IMPORT_SECONDS, **self.startup}
+        breakdown = ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in stages.items())
+        logger.info(f"⏱️ Startup: {breakdown}; ready {time.perf_counter() - PROCESS_STARTED:.2f}s after launch")
+    
+    def setup_handlers(self, route=None):
+        """Setup the BOT's single command router (route replaces self.route, e.g. to forward to workers)"""
+        # command -> (method, owner_only, reply for non-owners)
+        self.commands = {
+            'start': (self.start_command, True, "❌ This bot is for owners only"),
+            'play': (self.play_command, True, "❌ This command is for owners only"),
+            'search': (self.search_command, True, "❌ This command is for owners only"),
+            'stopmusic': (self.stop_command, True, None),
+            'pause': (self.pause_command, True, None),
+            'resume': (self.resume_command, True, None),
+            'queue': (self.queue_command, True, None),
+            'skip': (self.skip_command, True, None),
+            'remove': (self.remove_command, True, None),
+            'clear': (self.clear_command, True, None),
+            'help': (self.help_command, False, None),
+        }
         
-        @self.bot_client.on(events.NewMessage(pattern='/start'))
-        async def start_handler(event):
-            if event.sender_id in OWNERS:
-                await event.reply(
-                    "🎵 **Voice Chat Music Bot** 🎵\n\n"
-                    "**How it works:**\n"
-                    "1. You send command to ME (this bot)\n"
-                    "2. I call/invite USER ACCOUNT to join voice chat\n"
-                    "3. USER ACCOUNT plays the music\n\n"
-                    "**Commands:**\n"
-                    "• `/play [youtube_url]` - Play in current group's VC\n"
-                    "• Forward video + reply with `/play [group_link]`\n"
-                    "• `/stopmusic` - Stop playing\n"
-                    "• `/help` - Show help\n\n"
-                    f"**Owners:** {', '.join(map(str, OWNERS))}"
-                )
-            else:
-                await event.reply("❌ This bot is for owners only")
+        # The filter runs before Telethon schedules the handler, so ordinary
+        # group chatter is dropped without creating a coroutine
+        self.bot_client.add_event_handler(route or self.route, events.NewMessage(func=self.parse_command))
+    
+    def parse_command(self, event):
+        """Event filter: parse '/cmd@bot args' once and keep only messages we handle"""
+        text = event.raw_text
+        if not text or text[0] != '/':
+            # Only owners' media in private chat is handled besides commands
+            event.command = None
+            return bool(event.message.media) and event.is_private and event.sender_id in OWNER_IDS
         
-        @self.bot_client.on(events.NewMessage(pattern='/play'))
-        async def play_handler(event):
-            """Handle /play command from owners"""
-            if event.sender_id not in OWNERS:
-                await event.reply("❌ This command is for owners only")
+        head, *rest = text.split(None, 1)
+        name, _, mention = head[1:].partition('@')
+        if mention and mention.lower() != self.bot_username:
+            return False
+        
+        event.command = self.commands.get(name.lower())
+        event.command_args = rest[0].strip() if rest else ''
+        return event.command is not None
+    
+    async def route(self, event):
+        """Dispatch a message that passed parse_command"""
+        if event.command is None:
+            await self.media_hint(event)
+            return
+        
+        handler, owner_only, deny_text = event.command
+        metrics.inc('bot_commands_total', command=handler.__name__[:-len('_command')])
+        if owner_only and event.sender_id not in OWNER_IDS:
+            if deny_text:
+                await event.reply(deny_text)
+            return
+        
+        try:
+            await handler(event, event.command_args)
+        except Exception as e:
+            logger.error(f"Command error: {e}")
+            traceback.print_exc()
+            try:
+                await event.reply(f"❌ Error: {str(e)[:150]}")
+            except Exception as reply_error:
+                logger.error(f"Error reply failed: {reply_error}")
+    
+    async def start_command(self, event, args):
+        await event.reply(
+            "🎵 **Voice Chat Music Bot** 🎵\n\n"
+            "**How it works:**\n"
+            "1. You send command to ME (this bot)\n"
+            "2. I call/invite USER ACCOUNT to join voice chat\n"
+            "3. USER ACCOUNT plays the music\n\n"
+            "**Commands:**\n"
+            "• `/play [youtube_url]` - Play in current group's VC\n"
+            "• `/search [query]` - Play the top YouTube result\n"
+            "• Forward video + reply with `/play [group_link]`\n"
+            "• `/queue`, `/skip`, `/pause`, `/resume` - Control playback\n"
+            "• `/stopmusic` - Stop playing\n"
+            "• `/help` - Show help\n\n"
+            f"**Owners:** {', '.join(map(str, OWNERS))}"
+        )
+    
+    async def play_command(self, event, args):
+        """Handle /play command from owners"""
+        try:
+            # Check if it's a reply to forwarded media
+            if event.is_reply:
+                await self.handle_forwarded_media(event, args)
                 return
             
-            try:
-                # Check if it's a reply to forwarded media
-                if event.is_reply:
-                    await self.handle_forwarded_media(event)
-                    return
-                
-                # Regular YouTube play in current group
-                text = event.text.strip()
-                match = re.search(r'(https?://[^\s]+)', text)
-                
-                if not match:
-                    await event.reply("Please provide YouTube URL!\nExample: `/play https://youtu.be/VIDEO_ID`")
-                    return
-                
-                url = match.group(1)
+            # Regular YouTube play in current group
+            match = re.search(r'(https?://[^\s]+)', args)
+            
+            if not match:
+                await event.reply("Please provide YouTube URL!\nExample: `/play https://youtu.be/VIDEO_ID`")
+                return
+            
+            url = match.group(1)
+            # watch?v=X&list=Y plays X alone; only bare playlist links queue the playlist
+            if PLAYLIST_RE.search(url) and not YOUTUBE_ID_RE.search(url):
+                await self.play_playlist(event, url, "📃 Rest of the playlist")
+            else:
                 await self.play_in_current_group(event, url)
-                
+            
+        except Exception as e:
+            logger.error(f"Play error: {e}")
+            traceback.print_exc()
+            await event.reply(f"❌ Error: {str(e)[:150]}")
+    
+    async def search_command(self, event, args):
+        """Handle /search: queue the top YouTube result for the query"""
+        query = args.strip()
+        if not query:
+            await event.reply("Please provide a search query!\nExample: `/search never gonna give you up`")
+            return
+        await self.play_playlist(event, f"ytsearch1:{query}", f"🔎 {query}")
+    
+    async def stop_command(self, event, args):
+        chat_id = event.chat_id
+        cancelled = self.downloads.cancel(chat_id)
+        stopped = self.stop_queue(chat_id)
+        if chat_id in self.active_calls:
+            try:
+                # USER ACCOUNT leaves the voice chat
+                await self.accounts.call(chat_id, functions.phone.LeaveGroupCallRequest(
+                    call=self.active_calls[chat_id],
+                    source=VOICE_CHAT_SSRC
+                ))
+                self.drop_call(chat_id)
+                await event.reply("⏹️ USER ACCOUNT has left the voice chat")
             except Exception as e:
-                logger.error(f"Play error: {e}")
-                traceback.print_exc()
                 await event.reply(f"❌ Error: {str(e)[:150]}")
+        elif cancelled or stopped:
+            await event.reply("⏹️ Playback stopped and queue cleared")
+        else:
+            await event.reply("❌ No active voice chat in this group")
+    
+    async def pause_command(self, event, args):
+        queue = self.queues.get(event.chat_id)
+        if not queue.current:
+            await event.reply("❌ Nothing is playing")
+        elif queue.paused:
+            await event.reply("⏸️ Already paused")
+        else:
+            queue.pause()
+            self.queues.save(event.chat_id)
+            await self.set_muted(event.chat_id, True)
+            await event.reply("⏸️ Paused")
+    
+    async def resume_command(self, event, args):
+        queue = self.queues.get(event.chat_id)
+        if not queue.paused:
+            await event.reply("❌ Playback is not paused")
+        else:
+            queue.resume()
+            self.queues.save(event.chat_id)
+            await self.set_muted(event.chat_id, False)
+            await event.reply("▶️ Resumed")
+    
+    async def queue_command(self, event, args):
+        queue = self.queues.get(event.chat_id)
+        if not queue.current and not queue.entries:
+            await event.reply("📭 Queue is empty")
+            return
         
-        @self.bot_client.on(events.NewMessage(pattern='/stopmusic'))
-        async def stop_handler(event):
-            if event.sender_id not in OWNERS:
-                return
-            
-            chat_id = event.chat_id
-            if chat_id in self.active_calls:
-                try:
-                    # USER ACCOUNT leaves the voice chat
-                    await self.user_client(functions.phone.LeaveGroupCallRequest(
-                        call=self.active_calls[chat_id]
-                    ))
-                    del self.active_calls[chat_id]
-                    await event.reply("⏹️ USER ACCOUNT has left the voice chat")
-                except Exception as e:
-                    await event.reply(f"❌ Error: {str(e)[:150]}")
-            else:
-                await event.reply("❌ No active voice chat in this group")
-        
-        @self.bot_client.on(events.NewMessage(pattern='/pause'))
-        async def pause_handler(event):
-            if event.sender_id in OWNERS:
-                await event.reply("⏸️ Pause command received (feature coming soon)")
-        
-        @self.bot_client.on(events.NewMessage(pattern='/resume'))
-        async def resume_handler(event):
-            if event.sender_id in OWNERS:
-                await event.reply("▶️ Resume command received (feature coming soon)")
-        
-        @self.bot_client.on(events.NewMessage(pattern='/help'))
-        async def help_handler(event):
-            help_text = f"""
-            **🎵 Voice Chat Music Bot Help 🎵**
-            
-            **How it works:**
-            1. You send commands to THIS BOT
-            2. This bot calls USER ACCOUNT (@UserAccount)
-            3. USER ACCOUNT joins voice chat and plays music
-            
-            **Commands:**
-            • `/play [youtube_url]` - Play in current group
-            • Forward video, reply with `/play @GroupUsername`
-            • `/stopmusic` - Stop and leave VC
-            • `/pause` - Pause music (coming soon)
-            • `/resume` - Resume music (coming soon)
-            
-            **Requirements:**
-            • Bot must be admin in group
-            • USER ACCOUNT must be added to group
-            • Voice chat must be active
-            
-            **Owners only:** {', '.join(map(str, OWNERS))}
-            """
-            
-            await event.reply(help_text)
-        
-        @self.bot_client.on(events.NewMessage(incoming=True))
-        async def message_handler(event):
-            """Handle all incoming messages"""
+        lines = []
+        if queue.current:
+            state = "⏸️ Paused" if queue.paused else "▶️ Now playing"
+            lines.append(f"{state}: {queue.current['title']}\n")
+        for i, entry in enumerate(queue.entries[:QUEUE_LIST_LIMIT], 1):
+            lines.append(f"{i}. {entry['title']}")
+        if len(queue.entries) > QUEUE_LIST_LIMIT:
+            lines.append(f"... and {len(queue.entries) - QUEUE_LIST_LIMIT} more")
+        await event.reply("\n".join(lines))
+    
+    async def skip_command(self, event, args):
+        queue = self.queues.get(event.chat_id)
+        if not queue.current:
+            await event.reply("❌ Nothing is playing")
+            return
+        
+        title = queue.current['title']
+        was_paused = queue.paused
+        queue.skip()
+        if was_paused:
+            self.queues.save(event.chat_id)
+            await self.set_muted(event.chat_id, False)
+        await event.reply(f"⏭️ Skipped: {title}")
+    
+    async def remove_command(self, event, args):
+        queue = self.queues.get(event.chat_id)
+        match = re.match(r'(\d+)', args)
+        if not match:
+            await event.reply("Please provide a queue position!\nExample: `/remove 2`")
+            return
+        
+        entry = queue.remove(int(match.group(1)))
+        if not entry:
+            await event.reply("❌ No track at that position")
+            return
+        
+        self.queues.save(event.chat_id)
+        await event.reply(f"🗑️ Removed: {entry['title']}")
+    
+    async def clear_command(self, event, args):
+        queue = self.queues.get(event.chat_id)
+        count = queue.clear()
+        self.queues.save(event.chat_id)
+        await event.reply(f"🧹 Cleared {count} queued tracks")
+    
+    async def help_command(self, event, args):
+        help_text = f"""
+        **🎵 Voice Chat Music Bot Help 🎵**
+        
+        **How it works:**
+        1. You send commands to THIS BOT
+        2. This bot calls USER ACCOUNT (@UserAccount)
+        3. USER ACCOUNT joins voice chat and plays music
+        
+        **Commands:**
+        • `/play [youtube_url]` - Play in current group (playlists too)
+        • `/search [query]` - Play the top YouTube result
+        • Forward video, reply with `/play @GroupUsername`
+        • `/stopmusic` - Stop and leave VC
+        • `/pause` - Pause music
+        • `/resume` - Resume music
+        • `/queue` - Show the queue
+        • `/skip` - Skip the current track
+        • `/remove [n]` - Remove track n from the queue
+        • `/clear` - Clear the queue
+        
+        **Requirements:**
+        • Bot must be admin in group
+        • USER ACCOUNT must be added to group
+        • Voice chat must be active
+        
+        **Owners only:** {', '.join(map(str, OWNERS))}
+        """
+        
+        await event.reply(help_text)
+    
+    async def media_hint(self, event):
+        """Owner sent media in private chat - explain how to play it"""
+        try:
+            if event.video or event.document:
+                await event.reply(
+                    "📥 **Video received!**\n\n"
+                    "Now reply to this message with:\n"
+                    "`/play @GroupUsername`\n\n"
+                    "Example: `/play @MyMusicGroup`\n\n"
+                    "I will call USER ACCOUNT to join that group's VC!"
+                )
+        except Exception as e:
+            logger.error(f"Message handler error: {e}")
+    
+    def setup_user_handlers(self, client):
+        """Track voice chat state from a USER account's updates"""
+        
+        @client.on(events.Raw(types=[types.UpdateGroupCall, types.UpdateGroupCallParticipants]))
+        async def group_call_handler(update):
             try:
-                # Handle forwarded media from owners in private chat
-                if event.sender_id in OWNERS and event.is_private:
-                    if event.video or event.document:
-                        await event.reply(
-                            "📥 **Video received!**\n\n"
-                            "Now reply to this message with:\n"
-                            "`/play @GroupUsername`\n\n"
-                            "Example: `/play @MyMusicGroup`\n\n"
-                            "I will call USER ACCOUNT to join that group's VC!"
-                        )
+                if isinstance(update, types.UpdateGroupCall):
+                    self.group_calls.on_group_call(update)
+                    if isinstance(update.call, types.GroupCallDiscarded):
+                        self.forget_call(update.call.id)
+                elif self.group_calls.on_participants(update):
+                    self.forget_call(update.call.id)
             except Exception as e:
-                logger.error(f"Message handler error: {e}")
+                logger.error(f"Group call update error: {e}")
     
-    async def handle_forwarded_media(self, event):
+    def forget_call(self, call_id):
+        """USER ACCOUNT is no longer in this call (ended, kicked or left elsewhere)"""
+        for chat_id, call in list(self.active_calls.items()):
+            if getattr(call, 'id', None) == call_id:
+                self.drop_call(chat_id)
+                logger.info(f"📴 USER ACCOUNT is no longer in the voice chat of {chat_id}")
+    
+    async def handle_forwarded_media(self, event, args):
         """Handle when owner replies to forwarded media"""
         try:
             reply_msg = await event.get_reply_message()
@@ -218,8 +1790,7 @@ class VoiceChatMusicBot:
                 return
             
             # Extract group link/username
-            text = event.text.strip()
-            match = re.search(r'(https?://t\.me/(?:joinchat/)?[^\s]+|@[\w]+)', text)
+            match = re.search(r'(https?://t\.me/(?:joinchat/)?[^\s]+|@[\w]+)', args)
             
             if not match:
                 await event.reply("❌ Please provide group username\nExample: `/play @MyGroup`")
@@ -233,168 +1804,713 @@ class VoiceChatMusicBot:
             traceback.print_exc()
             await event.reply(f"❌ Error: {str(e)[:150]}")
     
-    async def play_in_current_group(self, event, youtube_url):
-        """Play YouTube in current group's voice chat"""
-        try:
-            chat_id = event.chat_id
-            
-            # Get chat info
-            chat = await self.bot_client.get_entity(chat_id)
-            chat_title = chat.title if hasattr(chat, 'title') else "this chat"
-            
-            await event.reply(f"🔍 Checking voice chat in {chat_title}...")
-            
-            # Get active voice chat
-            voice_chat = await self.get_group_call(chat_id)
-            if not voice_chat:
-                await event.reply(f"❌ No active voice chat in {chat_title}\nPlease start a voice chat first!")
+    async def play_in_current_group(self, event, youtube_url):
+        """Queue YouTube audio for the current group's voice chat"""
+        try:
+            chat_id = event.chat_id
+            
+            # Get chat info
+            chat_title = await self.get_chat_title(event)
+            
+            # One status message per request, the scheduler edits it as playback progresses
+            status = self.outbox.status(chat_id, reply_to=event.id)
+            await status.update(self.queued_text(chat_id, chat_title))
+            
+            self.enqueue(chat_id, {
+                'kind': 'youtube',
+                'url': youtube_url,
+                'title': youtube_url,
+                'duration': None,
+                'reply_chat': chat_id,
+                'reply_to': event.id,
+                'status_msg': status.message_id,
+            })
+            
+        except Exception as e:
+            logger.error(f"Play error: {e}")
+            traceback.print_exc()
+            await event.reply(f"❌ Error: {str(e)[:150]}")
+    
+    async def play_forwarded_in_group(self, event, media_msg, target_group):
+        """Queue forwarded media for the specified group"""
+        try:
+            status = self.outbox.status(event.chat_id, reply_to=event.id)
+            await status.update("🔍 Processing...")
+            
+            # Get target group
+            if not parse_chat_target(target_group):
+                await status.update("❌ Invalid group format. Use @Username")
+                return
+            
+            group = await self.resolve_chat(target_group)
+            if not group:
+                await status.update("❌ Group not found (USER ACCOUNT must be a member of private groups)")
+                return
+            
+            group_id = group['id']
+            group_title = group['title']
+            
+            # Check voice chat
+            await status.update(f"🔍 Checking voice chat in {group_title}...")
+            voice_chat = await self.get_group_call(group_id)
+            if not voice_chat:
+                await status.update(f"❌ No active voice chat in {group_title}")
+                return
+            
+            # Media already lives on Telegram, so it is resent by reference (no download)
+            media_key = f"tg-{media_msg.document.id}"
+            self.upload_cache.remember(media_key, media_msg)
+            
+            await status.update(self.queued_text(group_id, group_title))
+            await status.flush()
+            entry = {
+                'kind': 'media',
+                'key': media_key,
+                'title': media_msg.file.name or f"media_{media_msg.id}",
+                'duration': media_msg.file.duration,
+                'reply_chat': event.chat_id,
+                'reply_to': event.id,
+                'status_msg': status.message_id,
+                'source_chat': media_msg.chat_id,
+                'source_msg': media_msg.id,
+            }
+            if self.owns(group_id):
+                self.enqueue(group_id, entry)
+            else:
+                self.shard.hand_off(group_id, [entry])
+            
+        except Exception as e:
+            logger.error(f"Forwarded play error: {e}")
+            traceback.print_exc()
+            await event.reply(f"❌ Error: {str(e)[:150]}")
+    
+    async def play_playlist(self, event, url, title):
+        """Queue a playlist or search as a placeholder that resolves into tracks as they are needed"""
+        try:
+            chat_id = event.chat_id
+            status = self.outbox.status(chat_id, reply_to=event.id)
+            await status.update("📃 Loading...")
+            
+            self.enqueue(chat_id, {
+                'kind': 'playlist',
+                'url': url,
+                'title': title,
+                'duration': None,
+                'token': f"{random.getrandbits(48):x}",
+                'offset': 0,  # Entries already moved into the queue
+                'reply_chat': chat_id,
+                'reply_to': event.id,
+                'status_msg': status.message_id,
+            })
+            
+        except Exception as e:
+            logger.error(f"Playlist error: {e}")
+            traceback.print_exc()
+            await event.reply(f"❌ Error: {str(e)[:150]}")
+    
+    def queued_text(self, chat_id, chat_title):
+        queue = self.queues.get(chat_id)
+        if queue.current or queue.task:
+            return f"➕ Added to queue in {chat_title} (#{len(queue.entries) + 1})"
+        return f"🔍 Checking voice chat in {chat_title}..."
+    
+    def enqueue(self, chat_id, entry):
+        """Add entry to the chat queue, returns its position (0 when it plays right away)"""
+        queue = self.queues.get(chat_id)
+        queue.entries.append(entry)
+        position = len(queue.entries) if queue.current or queue.task else 0
+        self.queues.save(chat_id)
+        self.ensure_scheduler(chat_id)
+        return position
+    
+    def owns(self, chat_id):
+        """Whether this process plays chat_id (always, unless sharded)"""
+        return self.shard is None or self.shard.owns(chat_id)
+    
+    def hand_off_queue(self, chat_id):
+        """Move a chat's queue to the worker process that owns it"""
+        queue = self.queues.get(chat_id)
+        entries = ([queue.current] if queue.current else []) + queue.entries
+        queue.current = None
+        queue.entries = []
+        self.queues.save(chat_id)
+        self.shard.hand_off(chat_id, entries)
+        logger.info(f"🧩 Handed {len(entries)} queued tracks of {chat_id} to their worker")
+    
+    def ensure_scheduler(self, chat_id):
+        queue = self.queues.get(chat_id)
+        if queue.task is None or queue.task.done():
+            queue.task = asyncio.create_task(self.run_queue(chat_id))
+        else:
+            self.prefetch_upcoming(queue)
+    
+    async def run_queue(self, chat_id):
+        """Scheduler: play the chat queue track by track, prefetching what comes next"""
+        queue = self.queues.get(chat_id)
+        try:
+            while True:
+                if queue.current is None:
+                    if not queue.entries:
+                        break
+                    if queue.entries[0]['kind'] == 'playlist':
+                        # Nothing resolved yet, the expansion restarts the scheduler per entry
+                        self.expand_playlist(queue, queue.entries[0])
+                        break
+                    queue.current = queue.entries.pop(0)
+                    self.queues.save(chat_id)
+                
+                self.prefetch_upcoming(queue)
+                queue.skip_requested = False
+                try:
+                    duration = await self.play_entry(queue, queue.current)
+                except Exception as e:
+                    logger.error(f"Queue play error in {chat_id}: {e}")
+                    traceback.print_exc()
+                    duration = None
+                
+                if duration is not None:
+                    await queue.wait(duration or QUEUE_DEFAULT_DURATION)
+                
+                queue.current = None
+                self.queues.save(chat_id)
+        finally:
+            if queue.task is asyncio.current_task():
+                queue.task = None
+    
+    def prefetch_upcoming(self, queue):
+        """Download and transcode the next entries while the current one plays"""
+        for entry in queue.entries[:PLAYLIST_WINDOW]:
+            if entry['kind'] == 'playlist':
+                self.expand_playlist(queue, entry)
+        
+        # Stream mode never writes a whole track to disk, so each one streams when it comes up
+        if STREAM_MODE:
+            return
+        
+        for entry in queue.entries[:QUEUE_PREFETCH]:
+            url = entry.get('url')
+            if entry['kind'] != 'youtube' or url in queue.prefetch or self.is_cached(url):
+                continue
+            queue.prefetch[url] = asyncio.create_task(self.download_youtube(url))
+    
+    def expand_playlist(self, queue, placeholder):
+        """Start resolving the next batch of a playlist placeholder, unless that is already running"""
+        task = self.expansions.get(placeholder['token'])
+        if task is None or task.done():
+            self.expansions[placeholder['token']] = asyncio.create_task(self._expand_playlist(queue, placeholder))
+    
+    async def _expand_playlist(self, queue, placeholder):
+        loop = asyncio.get_running_loop()
+        
+        def on_entry(info):
+            # Each entry goes in ahead of the placeholder as soon as it resolves
+            index = next((i for i, entry in enumerate(queue.entries) if entry is placeholder), None)
+            if index is None:
+                return  # Removed, cleared or stopped meanwhile
+            url = info.get('url') or info.get('webpage_url') or ''
+            if not url.startswith('http'):
+                return
+            queue.entries.insert(index, {
+                'kind': 'youtube',
+                'url': url,
+                'title': info.get('title') or url,
+                'duration': info.get('duration'),
+                'reply_chat': placeholder['reply_chat'],
+                'reply_to': placeholder['reply_to'],
+                'status_msg': placeholder.pop('status_msg', None),  # First track takes over the status
+            })
+            placeholder['offset'] += 1
+            self.queues.save(queue.chat_id)
+            self.ensure_scheduler(queue.chat_id)
+        
+        try:
+            exhausted = await self.downloads.run(
+                queue.chat_id, self._expand_playlist_sync, placeholder, PLAYLIST_BATCH,
+                lambda info: loop.call_soon_threadsafe(on_entry, info)
+            )
+        except DownloadQueueFull:
+            # Try again once a worker is likely to be free
+            loop.call_later(5, self.ensure_scheduler, queue.chat_id)
+            return
+        except Exception as e:
+            logger.error(f"Playlist error for {placeholder['url']}: {e}")
+            exhausted = True
+        
+        await asyncio.sleep(0)  # Let the last on_entry callbacks run first
+        queued = any(entry is placeholder for entry in queue.entries)
+        if exhausted or not queued:
+            self.playlists.pop(placeholder['token'], None)
+            self.expansions.pop(placeholder['token'], None)
+        if exhausted:
+            if queued:
+                queue.entries = [entry for entry in queue.entries if entry is not placeholder]
+                self.queues.save(queue.chat_id)
+            if placeholder['offset'] == 0:
+                status = self.outbox.status(placeholder['reply_chat'], placeholder['reply_to'], placeholder.get('status_msg'))
+                await status.update("❌ Nothing found to play")
+                await status.flush()
+            elif placeholder.get('truncated'):
+                status = self.outbox.status(placeholder['reply_chat'], placeholder['reply_to'])
+                await status.update(f"📃 This Mix never ends, so only its first {PLAYLIST_MAX_ENTRIES} tracks were queued")
+                await status.flush()
+            logger.info(f"📃 {placeholder['url']}: {placeholder['offset']} entries queued")
+        self.ensure_scheduler(queue.chat_id)
+    
+    def _expand_playlist_sync(self, job, placeholder, count, on_entry):
+        """Pull the next count entries (yt-dlp fetches pages lazily), runs in a worker thread;
+        returns True once the playlist is exhausted"""
+        entries = self.playlists.get(placeholder['token'])
+        if entries is None:
+            # After a restart, skip what had already been queued
+            entries = itertools.islice(self._open_playlist(placeholder), placeholder['offset'], None)
+            self.playlists[placeholder['token']] = entries
+        
+        for _ in range(count):
+            if job.cancelled:
+                return False
+            info = next(entries, None)
+            if info is None:
+                return True
+            on_entry(info)
+        return False
+    
+    def _open_playlist(self, placeholder):
+        """Iterator over flat playlist/search entries, nothing is resolved until it is advanced"""
+        url = placeholder['url']
+        yt_dlp = load_yt_dlp()
+        # Not used as a context manager: the lazy entries need the instance after this returns
+        ydl = yt_dlp.YoutubeDL({'extract_flat': 'in_playlist', 'quiet': True})
+        info = ydl.extract_info(url, download=False, process=False)
+        for _ in range(3):
+            # Some playlist links first point at the playlist extractor
+            if info.get('_type') not in ('url', 'url_transparent'):
+                break
+            info = ydl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
+        
+        if info.get('_type') != 'playlist':
+            return iter([info])
+        if MIX_LIST_RE.search(url) or str(info.get('id') or '').startswith('RD'):
+            return self._capped_entries(info['entries'], placeholder)
+        return iter(info['entries'])
+    
+    @staticmethod
+    def _capped_entries(entries, placeholder):
+        """First PLAYLIST_MAX_ENTRIES entries, marking placeholder truncated when more follow"""
+        for index, info in enumerate(entries):
+            if index == PLAYLIST_MAX_ENTRIES:
+                placeholder['truncated'] = True
                 return
+            yield info
+    
+    async def fetch_audio(self, queue, url):
+        """Audio file for url, from its prefetch task when there is one"""
+        task = queue.prefetch.pop(url, None)
+        if task:
+            try:
+                audio_file = await task
+            except DownloadQueueFull:
+                audio_file = None
+            if audio_file and os.path.exists(audio_file):
+                return audio_file
+        return await self.download_youtube(url)
+    
+    async def fetch_entry_audio(self, queue, url, reply):
+        """Audio file for a queued YouTube entry, or None after telling the chat why not"""
+        if url not in queue.prefetch and self.audio_cache.key_for_url(url, AUDIO_FORMAT) not in self.audio_cache.entries:
+            await reply("⬇️ Downloading audio from YouTube...")
+        try:
+            audio_file = await self.fetch_audio(queue, url)
+        except DownloadQueueFull as e:
+            await reply(f"⏳ {e}")
+            return None
+        if not audio_file:
+            await reply("❌ Failed to download audio")
+        return audio_file
+    
+    async def play_entry(self, queue, entry):
+        """Play one queue entry, returns its duration in seconds or None if it failed"""
+        status = self.outbox.status(entry['reply_chat'], entry.get('reply_to'), entry.get('status_msg'))
+        started = time.perf_counter()
+        result = None
+        try:
+            result = await self._play_entry(queue, entry, status)
+            return result
+        finally:
+            entry['status_msg'] = status.message_id
+            await status.flush()
+            outcome = 'ok' if result is not None else 'failed'
+            metrics.observe('bot_play_seconds', time.perf_counter() - started, kind=entry['kind'])
+            metrics.inc('bot_plays_total', kind=entry['kind'], outcome=outcome)
+    
+    async def _play_entry(self, queue, entry, status):
+        chat_id = queue.chat_id
+        reply = status.update
+        
+        # Get active voice chat
+        voice_chat = await self.get_group_call(chat_id)
+        if not voice_chat:
+            await reply("❌ No active voice chat\nPlease start a voice chat first!")
+            return None
+        
+        if entry['kind'] == 'youtube':
+            url = entry['url']
+            key = self.audio_cache.key_for_url(url, AUDIO_FORMAT)
+            if key and key not in self.audio_cache.entries and key in self.upload_cache.entries:
+                # Only the earlier upload is left: it is resent by reference once joined,
+                # and downloaded again only if that fails
+                audio_file = None
+                meta = self.upload_cache.entries[key]
+            else:
+                if STREAM_MODE and not self.is_cached(url) and url not in queue.prefetch:
+                    return await self.stream_entry(queue, entry, voice_chat, status)
+                
+                # Download YouTube audio (usually already prefetched)
+                audio_file = await self.fetch_entry_audio(queue, url, reply)
+                if not audio_file:
+                    return None
+                key = self.audio_cache.key_for_path(audio_file) or f"file-{os.path.basename(audio_file)}"
+                meta = self.audio_cache.entries.get(key, {})
+            entry['title'] = meta.get('title') or entry['title']
+            entry['duration'] = meta.get('duration')
+        else:
+            source = await self.bot_client.get_messages(entry['source_chat'], ids=entry['source_msg'])
+            if not source or not source.media:
+                await reply("❌ The forwarded media is no longer available")
+                return None
+            # The command may have been handled by another worker, whose upload cache got the
+            # key; the freshly fetched message makes the resend by reference work here too
+            self.upload_cache.remember(entry['key'], source, {'title': entry['title'], 'duration': entry['duration']})
             
-            # Download YouTube audio
-            await event.reply("⬇️ Downloading audio from YouTube...")
-            audio_file = await self.download_youtube(youtube_url)
+            # Videos are played from their audio track only (falls back to the video itself)
+            key = audio_file = None
+            if source.video:
+                try:
+                    key, audio_file = await self.prepare_video_audio(source, status)
+                except DownloadQueueFull as e:
+                    await reply(f"⏳ {e}")
+                    return None
+        
+        if not await self.ensure_joined(chat_id, voice_chat, reply):
+            return None
+        
+        now_playing = (
+            f"✅ **Now playing:** {entry['title']}\n\n"
+            f"• USER ACCOUNT is in the voice chat\n"
+            f"• Up next: {len(queue.entries)} in queue\n\n"
+            f"Use `/skip`, `/pause` or `/stopmusic`"
+        )
+        await reply(now_playing)
+        await status.flush()
+        
+        if entry['kind'] == 'youtube':
+            caption = "🎵 Playing in voice chat (USER ACCOUNT)"
+            message = None
             if not audio_file:
-                await event.reply("❌ Failed to download audio")
-                return
-            
-            # USER ACCOUNT joins voice chat
-            await event.reply("📞 Calling USER ACCOUNT to join voice chat...")
-            
-            call = await self.join_voice_chat(chat_id, voice_chat)
-            if not call:
-                await event.reply("❌ USER ACCOUNT failed to join voice chat")
-                return
-            
-            self.active_calls[chat_id] = call
+                message = await self.send_audio(chat_id, key, caption)
+                if not message:
+                    audio_file = await self.fetch_entry_audio(queue, url, reply)
+                    if not audio_file:
+                        return None
+                    meta = self.audio_cache.entries.get(key, meta)
+            if not message:
+                # Send audio file (owned by the audio cache, so it is not deleted here)
+                with self.audio_cache.using(audio_file):
+                    await self.send_audio(chat_id, key, caption, file_path=audio_file, info=meta)
+        else:
+            caption = "🎵 **Music incoming!**\nUSER ACCOUNT is playing this in voice chat."
+            message = None
+            try:
+                if key and not audio_file:
+                    # Only an earlier upload of the audio is left; extract again if it cannot be resent
+                    message = await self.send_audio(chat_id, key, caption)
+                    if not message:
+                        audio_file = await self.extract_audio(source, key, status)
+                if not message:
+                    if audio_file:
+                        with self.audio_cache.using(audio_file):
+                            await self.send_audio(chat_id, key, caption, file_path=audio_file)
+                    else:
+                        await self.send_audio(chat_id, entry['key'], caption, source=source, status=status)
+            except DownloadQueueFull as e:
+                # Scratch space for the extraction or the download fallback is full
+                await reply(f"⏳ {e}")
+                return None
+            # Download progress of a fallback may have replaced the text meanwhile
+            await reply(now_playing)
+        
+        return entry['duration'] or 0
+    
+    async def stream_entry(self, queue, entry, voice_chat, status):
+        """Streaming variant of play_entry - nothing is written to disk"""
+        chat_id = queue.chat_id
+        reply = status.update
+        await reply("📡 Streaming audio from YouTube...")
+        stream = AudioStream()
+        producer = asyncio.create_task(self.stream_youtube(entry['url'], stream, chat_id))
+        try:
+            # USER ACCOUNT joins while the prebuffer fills
+            if not await self.ensure_joined(chat_id, voice_chat, reply):
+                return None
             
-            # Send success message
-            await event.reply(
-                f"✅ **Success!**\n\n"
-                f"• USER ACCOUNT has joined voice chat\n"
-                f"• Group: {chat_title}\n"
-                f"• Status: Playing audio\n\n"
-                f"Use `/stopmusic` to stop"
-            )
+            await stream.ready.wait()
+            if stream.failed:
+                logger.error(f"Stream error: {stream.error}")
+                await reply("❌ Failed to stream audio")
+                return None
             
-            # Send audio file
-            await self.bot_client.send_file(
-                chat_id,
-                audio_file,
-                caption="🎵 Playing in voice chat (USER ACCOUNT)"
+            entry['title'] = stream.title or entry['title']
+            entry['duration'] = stream.duration
+            await reply(
+                f"✅ **Now streaming:** {entry['title']}\n\n"
+                f"• USER ACCOUNT is in the voice chat\n"
+                f"• Up next: {len(queue.entries)} in queue\n\n"
+                f"Use `/skip`, `/pause` or `/stopmusic`"
             )
+            await status.flush()
             
-            # Cleanup
-            if os.path.exists(audio_file):
-                os.remove(audio_file)
-            
+            message = await self.send_stream(chat_id, stream, "🎵 Playing in voice chat (USER ACCOUNT)")
+            if stream.key:
+                self.upload_cache.remember(stream.key, message)
+            return entry['duration'] or 0
+        finally:
+            if not producer.done():
+                producer.cancel()
+    
+    async def ensure_joined(self, chat_id, voice_chat, reply):
+        """USER ACCOUNT joins the voice chat unless it is already in it"""
+        if chat_id in self.active_calls:
+            return self.active_calls[chat_id]
+        
+        await reply("📞 Calling USER ACCOUNT to join voice chat...")
+        call = await self.join_voice_chat(chat_id, voice_chat)
+        if not call:
+            await reply("❌ USER ACCOUNT failed to join voice chat")
+            return None
+        
+        self.remember_call(chat_id, call)
+        return call
+    
+    def stop_queue(self, chat_id):
+        """Stop the scheduler and drop everything queued in chat"""
+        queue = self.queues.get(chat_id)
+        stopped = bool(queue.current or queue.entries)
+        if queue.task:
+            queue.task.cancel()
+            queue.task = None
+        queue.clear()
+        queue.current = None
+        queue.paused = False  # The next /play starts unpaused
+        self.queues.save(chat_id)
+        return stopped
+    
+    async def set_muted(self, chat_id, muted):
+        """Mute or unmute USER ACCOUNT in the chat's voice chat"""
+        if chat_id not in self.active_calls:
+            return
+        try:
+            await self.accounts.call(chat_id, functions.phone.EditGroupCallParticipantRequest(
+                call=self.active_calls[chat_id],
+                participant=types.InputPeerSelf(),
+                muted=muted
+            ))
         except Exception as e:
-            logger.error(f"Play error: {e}")
-            traceback.print_exc()
-            await event.reply(f"❌ Error: {str(e)[:150]}")
+            logger.error(f"Mute error: {e}")
     
-    async def play_forwarded_in_group(self, event, media_msg, target_group):
-        """Play forwarded media in specified group"""
+    @timed('entity_resolve')
+    async def resolve_chat(self, target):
+        """Resolve @username, t.me link or invite link to {id, title}, or None"""
+        kind, value = parse_chat_target(target)
+        key = f"{kind}:{value}"
+        known, entry = self.entities.get(key)
+        if known:
+            return entry
+        
         try:
-            await event.reply("🔍 Processing...")
-            
-            # Get target group
-            if target_group.startswith('@'):
-                group_entity = await self.bot_client.get_entity(target_group)
-            elif 't.me/' in target_group:
-                username = target_group.split('/')[-1].replace('@', '')
-                group_entity = await self.bot_client.get_entity(username)
+            if kind == 'invite':
+                # Only resolvable when USER ACCOUNT is already in the group
+                invite = await self.user_client(functions.messages.CheckChatInviteRequest(value))
+                entity = getattr(invite, 'chat', None)
             else:
-                await event.reply("❌ Invalid group format. Use @Username")
-                return
-            
-            group_id = group_entity.id
-            group_title = group_entity.title
-            
-            # Check voice chat
-            await event.reply(f"🔍 Checking voice chat in {group_title}...")
-            voice_chat = await self.get_group_call(group_id)
-            if not voice_chat:
-                await event.reply(f"❌ No active voice chat in {group_title}")
-                return
-            
-            # Download media
-            await event.reply("⬇️ Downloading media...")
-            media_file = await self.download_media(media_msg)
-            if not media_file:
-                await event.reply("❌ Failed to download media")
-                return
-            
-            # USER ACCOUNT joins voice chat
-            await event.reply(f"📞 Calling USER ACCOUNT to join {group_title}...")
-            call = await self.join_voice_chat(group_id, voice_chat)
-            if not call:
-                await event.reply(f"❌ USER ACCOUNT failed to join {group_title}")
-                return
-            
-            self.active_calls[group_id] = call
-            
-            # Notify success
-            await event.reply(
-                f"✅ **Success!**\n\n"
-                f"• USER ACCOUNT joined: {group_title}\n"
-                f"• Voice chat: Active\n"
-                f"• Media: Ready to play"
-            )
-            
-            # Send to group
-            await self.bot_client.send_message(
-                group_id,
-                f"🎵 **Music incoming!**\nUSER ACCOUNT has joined to play media in voice chat."
-            )
-            
-            await self.bot_client.send_file(
-                group_id,
-                media_file,
-                caption="🎵 Playing in voice chat"
-            )
-            
-            # Cleanup
-            if os.path.exists(media_file):
-                os.remove(media_file)
-            
+                entity = await self.bot_client.get_entity(value)
+        except errors.FloodWaitError:
+            raise
+        except (ValueError, errors.RPCError) as e:
+            logger.info(f"Could not resolve {target}: {e}")
+            entity = None
+        
+        if not entity:
+            self.entities.put_missing(key)
+            return None
+        return self.entities.put(key, entity)
+    
+    @timed('entity_resolve')
+    async def get_chat_title(self, event):
+        known, entry = self.entities.get(f"id:{event.chat_id}")
+        if known and entry:
+            return entry['title']
+        
+        # Entities that came with the update, so usually no RPC
+        chat = await event.get_chat()
+        if not hasattr(chat, 'title'):
+            return "this chat"
+        return self.entities.put(f"id:{event.chat_id}", chat)['title']
+    
+    async def prewarm_entities(self):
+        """Fill the entity cache from USER ACCOUNT's group dialogs"""
+        try:
+            count = 0
+            async for dialog in self.user_client.iter_dialogs():
+                if dialog.is_group or dialog.is_channel:
+                    self.entities.put(f"id:{dialog.id}", dialog.entity)
+                    count += 1
+            self.entities.prune()
+            logger.info(f"📇 Entity cache warmed with {count} chats")
         except Exception as e:
-            logger.error(f"Forwarded play error: {e}")
-            traceback.print_exc()
-            await event.reply(f"❌ Error: {str(e)[:150]}")
+            logger.error(f"Entity prewarm error: {e}")
+    
+    async def send_audio(self, chat_id, key, caption, file_path=None, source=None, status=None, info=None):
+        """Send audio to chat, resending an earlier upload of key by reference when possible;
+        returns None when that fails and neither file_path nor source was given"""
+        document = self.upload_cache.get(key)
+        if document:
+            for attempt in range(2):
+                try:
+                    message = await self.send_document(chat_id, document, caption)
+                    logger.info(f"♻️ Resent {key} by file reference")
+                    return message
+                except errors.FileReferenceExpiredError:
+                    document = await self.refresh_file_reference(key) if attempt == 0 else None
+                    if not document:
+                        break
+                except errors.RPCError as e:
+                    logger.warning(f"Resend of {key} by reference failed: {e}")
+                    break
+            self.upload_cache.forget(key)
+        
+        if not file_path and not source:
+            return None
+        
+        # Fall back to a real upload (fetching the source message first if needed)
+        if not file_path and source and STREAM_MODE:
+            stream = AudioStream()
+            producer = asyncio.create_task(self.stream_telegram(source, stream))
+            try:
+                message = await self.send_stream(chat_id, stream, caption)
+            finally:
+                if not producer.done():
+                    producer.cancel()
+            self.upload_cache.remember(key, message, info)
+            return message
+        
+        if file_path:
+            message = await self.send_document(chat_id, file_path, caption)
+        else:
+            with self.scratch.job(source.file.size or SCRATCH_RESERVE_BYTES) as scratch:
+                file_path = await self.download_media(source, scratch, status)
+                if not file_path:
+                    raise RuntimeError("Failed to download media")
+                message = await self.send_document(chat_id, file_path, caption)
+        
+        self.upload_cache.remember(key, message, info)
+        return message
+    
+    @timed('upload')
+    async def send_document(self, chat_id, file, caption):
+        """Send a local file or an already uploaded document to chat"""
+        return await self.outbox.send_file(chat_id, file, caption=caption)
+    
+    @timed('upload')
+    async def send_stream(self, chat_id, stream, caption):
+        """Upload an AudioStream while it is produced and send it to chat"""
+        input_file = await self.upload_stream(stream)
+        return await self.outbox.send_file(chat_id, input_file, caption=caption)
     
+    async def upload_stream(self, stream):
+        """Streamed upload of unknown size (every part but the last has total_parts=-1)"""
+        file_id = random.getrandbits(63)
+        part = 0
+        held = None  # Last full part, sent once we know whether more data follows
+        pending = bytearray()
+        
+        async for chunk in stream:
+            pending += chunk
+            while len(pending) >= STREAM_PART_SIZE:
+                if held is not None:
+                    await self.bot_client(functions.upload.SaveBigFilePartRequest(file_id, part, -1, held))
+                    part += 1
+                held = bytes(pending[:STREAM_PART_SIZE])
+                del pending[:STREAM_PART_SIZE]
+        
+        tail = [data for data in (held, bytes(pending)) if data]
+        if not tail:
+            raise RuntimeError("Stream produced no audio")
+        
+        total_parts = part + len(tail)
+        for data in tail:
+            await self.bot_client(functions.upload.SaveBigFilePartRequest(file_id, part, total_parts, data))
+            part += 1
+        
+        return types.InputFileBig(id=file_id, parts=total_parts, name=stream.name)
+    
+    async def refresh_file_reference(self, key):
+        """Fetch a fresh file reference from the message the document was last seen in"""
+        entry = self.upload_cache.entries.get(key)
+        if not entry:
+            return None
+        try:
+            message = await self.bot_client.get_messages(entry['chat_id'], ids=entry['msg_id'])
+        except Exception as e:
+            logger.warning(f"File reference refresh failed for {key}: {e}")
+            return None
+        
+        if not message or not message.document:
+            return None
+        self.upload_cache.remember(key, message)
+        return self.upload_cache.get(key)
+    
+    @timed('group_call_lookup')
     async def get_group_call(self, chat_id):
-        """Get active group call"""
+        """Get active group call (from updates when possible, otherwise one cached RPC)"""
+        known, call = self.group_calls.get(chat_id)
+        if known:
+            return call
+        
         try:
-            # Try to get full chat info
-            full_chat = await self.bot_client(functions.messages.GetFullChatRequest(chat_id))
-            
-            if hasattr(full_chat.full_chat, 'call') and full_chat.full_chat.call:
-                return full_chat.full_chat.call
+            # Supergroups/channels and basic groups need different full-chat requests
+            peer_id, peer_type = utils.resolve_id(chat_id)
+            if peer_type is types.PeerChannel:
+                full_chat = await self.bot_client(functions.channels.GetFullChannelRequest(chat_id))
+            else:
+                full_chat = await self.bot_client(functions.messages.GetFullChatRequest(peer_id))
             
-            return None
+            call = getattr(full_chat.full_chat, 'call', None)
+            self.group_calls.set(chat_id, call)
+            return call
             
         except Exception as e:
             logger.error(f"Get group call error: {e}")
             return None
     
+    @timed('vc_join')
     async def join_voice_chat(self, chat_id, group_call):
         """USER ACCOUNT joins voice chat"""
         try:
-            # USER CLIENT joins using their API credentials
-            result = await self.user_client(functions.phone.JoinGroupCallRequest(
+            # A pool account joins using its API credentials
+            await self.accounts.join(chat_id, functions.phone.JoinGroupCallRequest(
                 call=group_call,
+                join_as=types.InputPeerSelf(),
                 muted=False,
                 video_stopped=False,
                 params=types.DataJSON(data=json.dumps({
                     'ufrag': 'user',
                     'pwd': 'pass',
                     'fingerprints': [],
-                    'ssrc': 1234567890,
+                    'ssrc': VOICE_CHAT_SSRC,
                 }))
             ))
             
             logger.info(f"✅ USER ACCOUNT joined voice chat in chat {chat_id}")
-            return result.call
+            return group_call
             
         except Exception as e:
             logger.error(f"Join voice chat error: {e}")
@@ -402,44 +2518,279 @@ class VoiceChatMusicBot:
             return None
     
     async def download_youtube(self, url):
-        """Download YouTube audio"""
-        try:
-            os.makedirs("downloads", exist_ok=True)
-            
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-                'outtmpl': 'downloads/%(id)s.%(ext)s',
-                'quiet': True,
-            }
-            
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                filename = ydl.prepare_filename(info)
-                audio_file = os.path.splitext(filename)[0] + '.mp3'
-                
-                # Check if file exists
-                if os.path.exists(audio_file):
-                    return audio_file
-                elif os.path.exists(filename):
-                    return filename
-                else:
-                    return None
-                
+        """Download YouTube audio in the download executor (one download per video, shared by
+        every chat that wants it; cancelling a caller only cancels the download once none is left)"""
+        # Cache hit for a known video ID skips yt-dlp and never takes a download slot
+        key = self.audio_cache.key_for_url(url, AUDIO_FORMAT)
+        cached = self.audio_cache.get(key) if key else None
+        if cached:
+            logger.info(f"🗄️ Audio cache hit: {key}")
+            return cached
+        
+        flight_key = key or url.strip()
+        try:
+            return await self.in_flight.run(
+                flight_key,
+                lambda: self.downloads.run(flight_key, self._download_youtube_sync, url)
+            )
+        except DownloadQueueFull:
+            raise
         except Exception as e:
-            logger.error(f"YouTube download error: {e}")
+            # yt_dlp is loaded by then; the download thread imported it
+            if yt_dlp and isinstance(e, yt_dlp.utils.DownloadCancelled):
+                logger.info(f"YouTube download cancelled: {url}")
+            else:
+                logger.error(f"YouTube download error: {e}")
             return None
     
-    async def download_media(self, message):
-        """Download Telegram media"""
+    def _download_youtube_sync(self, job, url):
+        """Blocking yt-dlp download, runs in a worker thread"""
+        yt_dlp = load_yt_dlp()
+        if job.cancelled:
+            raise yt_dlp.utils.DownloadCancelled()
+        
+        # Known video IDs were already looked up in the cache by download_youtube
+        key = self.audio_cache.key_for_url(url, AUDIO_FORMAT)
+        
+        def progress_hook(d):
+            if job.cancelled:
+                raise yt_dlp.utils.DownloadCancelled()
+        
+        # Transcode time is measured separately from the download itself. CPU comes
+        # from finished children, so concurrent transcodes can blur into each other
+        transcode = {'seconds': 0, 'cpu': 0}
+        
+        def postprocessor_hook(d):
+            if d['status'] == 'started':
+                transcode['started'] = time.perf_counter()
+                transcode['cpu_started'] = children_cpu_seconds()
+            elif d['status'] == 'finished' and 'started' in transcode:
+                transcode['seconds'] += time.perf_counter() - transcode.pop('started')
+                transcode['cpu'] += children_cpu_seconds() - transcode.pop('cpu_started')
+        
+        # Formats that already match the profile are only remuxed (ffmpeg -acodec copy)
+        profile = AUDIO_PROFILES[AUDIO_PROFILE]
+        ydl_opts = {
+            'format': profile['format'],
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': profile['codec'],
+                'preferredquality': profile['bitrate'],
+            }],
+            'noplaylist': True,
+            'progress_hooks': [progress_hook],
+            'postprocessor_hooks': [postprocessor_hook],
+            'quiet': True,
+        }
+        
+        # Everything yt-dlp writes (.part files, intermediates) lives in the job's
+        # scratch directory, which is removed however the download ends
+        with self.scratch.job() as scratch, yt_dlp.YoutubeDL(
+            dict(ydl_opts, outtmpl=os.path.join(scratch.path, '%(id)s.%(ext)s'))
+        ) as ydl:
+            info = ydl.extract_info(url, download=False)
+            
+            # Other sites only reveal their video ID after extraction
+            if not key:
+                key = self.audio_cache.make_key(info['extractor_key'], info['id'], AUDIO_FORMAT)
+                cached = self.audio_cache.get(key)
+                if cached:
+                    logger.info(f"🗄️ Audio cache hit: {key}")
+                    return cached
+            
+            # Admission against the scratch quota, now that the size is (roughly) known
+            self.scratch.reserve(scratch, info.get('filesize') or info.get('filesize_approx') or SCRATCH_RESERVE_BYTES)
+            
+            started = time.perf_counter()
+            info = ydl.process_ie_result(info, download=True)
+            metrics.observe('bot_play_stage_seconds', time.perf_counter() - started - transcode['seconds'], stage='download')
+            metrics.observe('bot_play_stage_seconds', transcode['seconds'], stage='transcode')
+            
+            mode = 'encode' if needs_reencode(profile['codec'], info.get('acodec')) else 'copy'
+            metrics.observe('bot_transcode_cpu_seconds', transcode['cpu'], profile=AUDIO_PROFILE, mode=mode)
+            logger.info(f"🎚️ {key}: {info.get('acodec')} -> {profile['codec']} ({mode}), transcode CPU {transcode['cpu']:.2f}s")
+            
+            # Postprocessors change the extension, the final path is reported back
+            requested = info.get('requested_downloads') or [{}]
+            audio_file = requested[0].get('filepath') or ydl.prepare_filename(info)
+            
+            # Check if file exists
+            if os.path.exists(audio_file):
+                return self.audio_cache.put(key, audio_file, info)
+            else:
+                return None
+    
+    def is_cached(self, url):
+        """True when url can be served from the audio or upload cache"""
+        key = self.audio_cache.key_for_url(url, AUDIO_FORMAT)
+        return bool(key) and (key in self.upload_cache.entries or key in self.audio_cache.entries)
+    
+    async def stream_youtube(self, url, stream, chat_id=None):
+        """Producer: pipe the best audio format through ffmpeg into stream"""
+        try:
+            info = await self.downloads.run(chat_id, self._extract_stream_info_sync, url)
+            stream.key = self.audio_cache.make_key(info['extractor_key'], info['id'], AUDIO_FORMAT)
+            output_args, ext = stream_output_args(AUDIO_PROFILES[AUDIO_PROFILE], info.get('acodec'))
+            stream.name = f"{info['id']}{ext}"
+            stream.title = info.get('title')
+            stream.duration = info.get('duration')
+            
+            cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error']
+            headers = ''.join(f"{k}: {v}\r\n" for k, v in info.get('http_headers', {}).items())
+            if headers:
+                cmd += ['-headers', headers]
+            cmd += ['-i', info['url'], '-vn', *output_args, 'pipe:1']
+            await self.pipe_process(cmd, stream)
+            await stream.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await stream.close(e)
+    
+    def _extract_stream_info_sync(self, job, url):
+        """Resolve the direct audio URL without downloading, runs in a worker thread"""
+        yt_dlp = load_yt_dlp()
+        ydl_opts = {'format': AUDIO_PROFILES[AUDIO_PROFILE]['format'], 'noplaylist': True, 'quiet': True}
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            return ydl.extract_info(url, download=False)
+    
+    async def stream_telegram(self, message, stream):
+        """Producer: feed Telegram media into stream via iter_download"""
+        try:
+            stream.name = message.file.name or f"media_{message.id}{message.file.ext or ''}"
+            stream.duration = message.file.duration
+            async for chunk in self.bot_client.iter_download(message.media):
+                await stream.put(chunk)
+            await stream.close()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await stream.close(e)
+    
+    async def pipe_process(self, cmd, stream):
+        """Run cmd and push its stdout into stream chunk by chunk"""
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            while True:
+                chunk = await process.stdout.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await stream.put(chunk)
+            
+            stderr = await process.stderr.read()
+            if await process.wait() != 0:
+                raise RuntimeError(f"{cmd[0]} failed: {stderr.decode(errors='replace')[-150:]}")
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+    
+    async def prepare_video_audio(self, message, status):
+        """Audio track of a Telegram video from the audio cache, extracting it on first use;
+        returns (key, path), path None when only an earlier upload is left, or (None, None)"""
+        key = self.audio_cache.make_key('tg', message.document.id, AUDIO_FORMAT)
+        audio_file = self.audio_cache.get(key)
+        if audio_file or key in self.upload_cache.entries:
+            return key, audio_file
+        
+        await status.update("🎚️ Extracting audio from video...")
+        audio_file = await self.extract_audio(message, key, status)
+        return (key, audio_file) if audio_file else (None, None)
+    
+    @timed('audio_extract')
+    async def extract_audio(self, message, key, status=None):
+        """Demux only the audio track of a Telegram video into the audio cache"""
+        profile = AUDIO_PROFILES[AUDIO_PROFILE]
+        if profile['codec'] in ('best', 'm4a'):
+            # Video audio is nearly always AAC, which is copied; anything else is encoded
+            attempts = [
+                (['-codec:a', 'copy', '-f', 'mp4'], '.m4a'),
+                (['-codec:a', 'aac', '-b:a', f"{profile['bitrate']}k", '-f', 'mp4'], '.m4a'),
+            ]
+        else:
+            output_args, ext = stream_output_args(profile, None)
+            attempts = [(output_args, ext)]
+        
+        # Only the audio is written, so the reservation is a fraction of the video
+        with self.scratch.job(max(message.file.size // 8, SCRATCH_RESERVE_BYTES)) as scratch:
+            output = os.path.join(scratch.path, 'audio' + attempts[0][1])
+            try:
+                # Telegram media goes straight into ffmpeg, the video never touches disk
+                extracted = await self.ffmpeg_extract(['-i', 'pipe:0'], attempts[0][0], output, message)
+                if not extracted:
+                    # Not streamable (index at the end of the file) or the copy failed:
+                    # fall back to a local copy of the whole video
+                    self.scratch.reserve(scratch, scratch.reserved + message.file.size)
+                    video = await self.download_media(message, scratch, status)
+                    if video:
+                        for output_args, ext in attempts:
+                            output = os.path.join(scratch.path, 'audio' + ext)
+                            extracted = await self.ffmpeg_extract(['-i', video], output_args, output)
+                            if extracted:
+                                break
+            except FileNotFoundError:
+                logger.error("❌ ffmpeg is not installed, sending the video as is")
+                return None
+            
+            if not extracted:
+                logger.warning(f"Audio extraction failed for media {message.id}")
+                return None
+            
+            logger.info(f"🎚️ Extracted audio of media {message.id}: {os.path.getsize(output) / 1048576:.1f} MB "
+                        f"from a {message.file.size / 1048576:.1f} MB video")
+            # A copy across filesystems would block the event loop
+            return await asyncio.get_running_loop().run_in_executor(None, self.audio_cache.put, key, output, {
+                'title': message.file.name or f"media_{message.id}",
+                'duration': message.file.duration,
+            })
+    
+    async def ffmpeg_extract(self, input_args, output_args, output, message=None):
+        """Run ffmpeg -vn into output, feeding message's media through stdin when given"""
+        cmd = ['ffmpeg', '-loglevel', 'error', '-y', *input_args, '-vn', '-sn', '-dn', *output_args, output]
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE if message else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stderr = asyncio.create_task(process.stderr.read())
         try:
-            os.makedirs("downloads", exist_ok=True)
+            if message:
+                # Large media is fetched as parallel parts, reassembled in order for the pipe
+                parallel = (message.file.size or 0) >= MEDIA_PARALLEL_MIN_BYTES
+                if parallel:
+                    chunks = self.iter_media_parallel(message)
+                else:
+                    chunks = self.bot_client.iter_download(message.media, request_size=MEDIA_PART_SIZE)
+                try:
+                    async for chunk in chunks:
+                        process.stdin.write(chunk)
+                        await process.stdin.drain()
+                    process.stdin.close()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # ffmpeg gave up early, its exit code says why
+                finally:
+                    if parallel:
+                        await chunks.aclose()
             
-            filename = f"downloads/media_{int(time.time())}_{message.id}"
+            if await process.wait() != 0:
+                logger.info(f"ffmpeg extraction failed: {(await stderr).decode(errors='replace').strip()[-150:]}")
+                return False
+            return os.path.isfile(output) and os.path.getsize(output) > 0
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+    
+    @timed('media_download')
+    async def download_media(self, message, scratch, status=None):
+        """Download Telegram media into a scratch job's directory"""
+        try:
+            filename = os.path.join(scratch.path, f"media_{message.id}")
             
             if message.video:
                 filename += ".mp4"
@@ -454,6 +2805,18 @@ class VoiceChatMusicBot:
                 else:
                     filename += ".file"
             
+            if SCRATCH_PREALLOCATE and message.file.size:
+                self.scratch.preallocate(filename, message.file.size)
+            
+            if (message.file.size or 0) >= MEDIA_PARALLEL_MIN_BYTES:
+                await self.download_parallel(message, filename, status)
+                return filename
+            
+            if SCRATCH_PREALLOCATE and message.file.size:
+                with open(filename, 'r+b') as f:
+                    await message.download_media(file=f)
+                return filename
+            
             file_path = await message.download_media(file=filename)
             return file_path
             
@@ -461,6 +2824,142 @@ class VoiceChatMusicBot:
             logger.error(f"Media download error: {e}")
             return None
     
+    async def download_parallel(self, message, path, status=None):
+        """Fetch a file as 512 KB parts over concurrent requests, each written at its offset"""
+        size = message.file.size
+        parts = asyncio.Queue()
+        for offset in range(0, size, MEDIA_PART_SIZE):
+            parts.put_nowait(offset)
+        bucket = TokenBucket(MEDIA_JOB_RATE_BYTES, MEDIA_PART_SIZE) if MEDIA_JOB_RATE_BYTES else None
+        progress = {'bytes': 0, 'step': 0}
+        started = time.perf_counter()
+        
+        async def worker(fd):
+            while not parts.empty():
+                offset = parts.get_nowait()
+                data = await self.fetch_media_part(message, offset)
+                if bucket:
+                    await bucket.acquire(len(data))
+                os.pwrite(fd, data, offset)
+                
+                progress['bytes'] += len(data)
+                step = progress['bytes'] * 20 // size  # Status edits every 5%
+                if status and step > progress['step']:
+                    progress['step'] = step
+                    await status.update(
+                        f"⬇️ Downloading media... {progress['bytes'] * 100 // size}% "
+                        f"({progress['bytes'] / 1048576:.0f}/{size / 1048576:.0f} MB)"
+                    )
+        
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+        try:
+            os.ftruncate(fd, size)
+            workers = [asyncio.create_task(worker(fd)) for _ in range(min(MEDIA_DOWNLOAD_WORKERS, parts.qsize()))]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+        finally:
+            os.close(fd)
+        
+        elapsed = time.perf_counter() - started
+        logger.info(f"⬇️ Media {message.id}: {size / 1048576:.1f} MB in {elapsed:.1f}s ({size / 1048576 / max(elapsed, 1e-6):.1f} MB/s)")
+    
+    async def fetch_media_part(self, message, offset):
+        """One MEDIA_PART_SIZE part of message's media"""
+        # limit=1 at a part-aligned offset is a single GetFile request, since
+        # MEDIA_PART_SIZE is Telethon's largest request_size (it follows the
+        # file's DC itself); failed parts are retried on their own
+        for attempt in range(MEDIA_PART_RETRIES + 1):
+            try:
+                chunks = [chunk async for chunk in self.bot_client.iter_download(
+                    message.media, offset=offset, limit=1, request_size=MEDIA_PART_SIZE, file_size=message.file.size
+                )]
+                return b''.join(chunks)
+            except errors.FloodWaitError as e:
+                await asyncio.sleep(e.seconds)
+            except (errors.RPCError, ConnectionError, asyncio.TimeoutError) as e:
+                if attempt == MEDIA_PART_RETRIES:
+                    raise
+                metrics.inc('bot_media_part_retries_total')
+                logger.warning(f"Part at {offset} of media {message.id} failed ({e}), retrying")
+                await asyncio.sleep(2 ** attempt)
+        raise RuntimeError(f"Part at {offset} kept hitting FloodWait")
+    
+    async def iter_media_parallel(self, message):
+        """Yield message's media part by part in order, with up to MEDIA_DOWNLOAD_WORKERS
+        parts in flight, so a pipe reader gets the parallel download's throughput"""
+        offsets = iter(range(0, message.file.size, MEDIA_PART_SIZE))
+        bucket = TokenBucket(MEDIA_JOB_RATE_BYTES, MEDIA_PART_SIZE) if MEDIA_JOB_RATE_BYTES else None
+        window = [asyncio.create_task(self.fetch_media_part(message, offset))
+                  for offset in itertools.islice(offsets, MEDIA_DOWNLOAD_WORKERS)]
+        try:
+            while window:
+                data = await window.pop(0)
+                offset = next(offsets, None)
+                if offset is not None:
+                    window.append(asyncio.create_task(self.fetch_media_part(message, offset)))
+                if bucket:
+                    await bucket.acquire(len(data))
+                yield data
+        finally:
+            for task in window:
+                task.cancel()
+    
+    async def sweep_scratch(self):
+        """Periodically remove scratch files no job owns"""
+        while True:
+            await asyncio.sleep(SCRATCH_SWEEP_INTERVAL)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.scratch.sweep)
+            except Exception as e:
+                logger.error(f"Scratch sweep error: {e}")
+    
+    async def monitor_loop_lag(self, interval=1.0):
+        """Measure how late the event loop wakes up - blocking code shows up here"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag = max(0.0, loop.time() - started - interval)
+            metrics.observe('bot_event_loop_lag_seconds', self.loop_lag)
+    
+    def gauges(self):
+        """Point-in-time values for /metrics as (name, labels, value)"""
+        def connected(client):
+            return int(bool(client and client.is_connected()))
+        
+        queues = list(self.queues.queues.values())  # Read from the Flask thread
+        queued = sum(len(queue.entries) for queue in queues)
+        playing = sum(1 for queue in queues if queue.current)
+        return [
+            ('bot_client_connected', {'client': 'bot'}, connected(self.bot_client)),
+            ('bot_client_connected', {'client': 'user'}, connected(self.user_client)),
+            ('bot_active_calls', {}, len(self.active_calls)),
+            ('bot_queue_entries', {}, queued),
+            ('bot_queues_playing', {}, playing),
+            ('bot_download_jobs', {'state': 'pending'}, self.downloads.pending),
+            ('bot_download_jobs', {'state': 'waiting'}, self.downloads.waiting),
+            ('bot_event_loop_lag_seconds_last', {}, self.loop_lag),
+            ('bot_flood_wait_seconds_total', {}, self.outbox.flood_wait_seconds),
+            ('bot_cache_hits_total', {'cache': 'audio'}, self.audio_cache.hits),
+            ('bot_cache_misses_total', {'cache': 'audio'}, self.audio_cache.misses),
+            ('bot_cache_hits_total', {'cache': 'entity'}, self.entities.hits),
+            ('bot_cache_misses_total', {'cache': 'entity'}, self.entities.misses),
+            ('bot_cache_hits_total', {'cache': 'group_call'}, self.group_calls.hits),
+            ('bot_cache_misses_total', {'cache': 'group_call'}, self.group_calls.misses),
+            ('bot_cache_hits_total', {'cache': 'upload'}, self.upload_cache.hits),
+            ('bot_cache_misses_total', {'cache': 'upload'}, self.upload_cache.misses),
+            ('bot_audio_cache_bytes', {}, self.audio_cache.total_bytes),
+            ('bot_downloads_dir_bytes', {}, directory_size(self.scratch.root)),
+            ('bot_scratch_reserved_bytes', {}, self.scratch.reserved),
+            ('bot_scratch_jobs', {}, len(self.scratch.jobs)),
+            ('bot_scratch_rejected_total', {}, self.scratch.rejected),
+            ('bot_state_pending_writes', {}, len(self.store.pending)),
+            *self.accounts.gauges(),
+        ]
+    
     async def run(self):
         """Main run method"""
         try:
@@ -474,6 +2973,281 @@ class VoiceChatMusicBot:
         except Exception as e:
             logger.error(f"Run error: {e}")
             traceback.print_exc()
+        finally:
+            if self.state == 'starting':
+                self.state = 'failed'
+            self.downloads.shutdown()
+            self.queues.save()
+            self.store.close()
+
+# ================= SHARDING =================
+class HashRing:
+    """Consistent hashing of chat ids onto worker indexes"""
+    def __init__(self, nodes, replicas=160):
+        self.ring = sorted((self._hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas))
+        self.hashes = [h for h, _ in self.ring]
+    
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+    
+    def node_for(self, key):
+        index = bisect.bisect(self.hashes, self._hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class IpcChannel:
+    """Pickled {'op': ...} messages over a multiprocessing Pipe, received on the event loop
+    and sent from a thread, so a slow peer never blocks the loop"""
+    def __init__(self, conn):
+        self.conn = conn
+        self.sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ipc-send')  # Keeps send order
+        self.closed = False
+        self.handler = None
+        self.on_close = None
+    
+    def start(self, handler, on_close=None):
+        self.handler = handler
+        self.on_close = on_close
+        asyncio.get_running_loop().add_reader(self.conn.fileno(), self._readable)
+    
+    def _readable(self):
+        try:
+            message = self.conn.recv()
+        except (EOFError, OSError):
+            self.close()
+            if self.on_close:
+                self.on_close()
+            return
+        asyncio.create_task(self._dispatch(message))
+    
+    async def _dispatch(self, message):
+        try:
+            await self.handler(message)
+        except Exception as e:
+            logger.error(f"IPC {message.get('op')} error: {e}")
+            traceback.print_exc()
+    
+    def send(self, op, **payload):
+        """Queue a message for the sender thread, returns False once the channel is closed"""
+        if self.closed:
+            return False
+        self.sender.submit(self._send, {'op': op, **payload})
+        return True
+    
+    def _send(self, message):
+        if self.closed:
+            return
+        try:
+            self.conn.send(message)
+        except (EOFError, OSError) as e:
+            logger.warning(f"IPC {message['op']} not delivered: {e}")
+    
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.sender.shutdown(wait=False, cancel_futures=True)
+        try:
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+        except (RuntimeError, ValueError, OSError):
+            pass
+        self.conn.close()
+
+
+class ShardWorker:
+    """Worker process side: plays the chats that hash to index, commands come from the supervisor"""
+    def __init__(self, index, count, conn, user_sessions=()):
+        self.index = index
+        self.name = f"worker-{index}"
+        self.user_sessions = list(user_sessions)  # Extra accounts only this worker uses
+        self.ring = HashRing(range(count))
+        self.channel = IpcChannel(conn)
+        self.bot = None
+    
+    def owns(self, chat_id):
+        return self.ring.node_for(chat_id) == self.index
+    
+    def hand_off(self, chat_id, entries):
+        self.channel.send('handoff', chat_id=chat_id, entries=entries)
+    
+    def attach(self, bot):
+        self.bot = bot
+        self.channel.start(self.on_message, on_close=self.on_supervisor_gone)
+        asyncio.create_task(self.publish_status())
+    
+    async def on_message(self, message):
+        if message['op'] == 'event':
+            # Rebuild the NewMessage event the supervisor received, with its entities,
+            # so the usual router and command methods run unchanged
+            entities = [BinaryReader(data).tgread_object() for data in message['entities']]
+            self.bot.bot_client.session.process_entities(entities)
+            event = events.NewMessage.Event(BinaryReader(message['message']).tgread_object())
+            event._entities = {utils.get_peer_id(entity): entity for entity in entities}
+            event._set_client(self.bot.bot_client)
+            if self.bot.parse_command(event):
+                await self.bot.route(event)
+        elif message['op'] == 'enqueue':
+            for entry in message['entries']:
+                self.bot.enqueue(message['chat_id'], entry)
+    
+    def on_supervisor_gone(self):
+        logger.error(f"❌ Worker {self.index} lost its supervisor, shutting down")
+        for client in (self.bot.bot_client, self.bot.user_client):
+            if client:
+                asyncio.create_task(client.disconnect())
+    
+    async def publish_status(self):
+        """Periodic snapshot for the supervisor's /, /health and /metrics"""
+        while not self.channel.closed:
+            bot = self.bot
+            self.channel.send(
+                'status',
+                pid=os.getpid(),
+                time=time.time(),
+                chats=sorted(set(bot.active_calls) | set(bot.queues.pending())),
+                clients={
+                    'bot': bool(bot.bot_client and bot.bot_client.is_connected()),
+                    'user': bool(bot.user_client and bot.user_client.is_connected()),
+                },
+                metrics=metrics.render(bot.gauges(), extra=[('worker', self.index)]),
+            )
+            await asyncio.sleep(WORKER_STATUS_INTERVAL)
+
+
+class Supervisor:
+    """Front process: takes commands on the bot account and routes each chat to its worker process"""
+    def __init__(self, count=WORKERS):
+        self.count = count
+        self.name = 'supervisor'
+        self.user_sessions = []  # The router never joins voice chats
+        self.ring = HashRing(range(count))
+        self.front = VoiceChatMusicBot(shard=self)  # Router only, never plays
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = {}  # index -> Process
+        self.channels = {}  # index -> IpcChannel
+        self.status = {}  # index -> last status message
+        self.given_up = set()  # Workers that exited with WORKER_CONFIG_ERROR
+    
+    def owns(self, chat_id):
+        return False
+    
+    def hand_off(self, chat_id, entries):
+        self.channels[self.ring.node_for(chat_id)].send('enqueue', chat_id=chat_id, entries=entries)
+    
+    def start_worker(self, index):
+        parent, child = self.context.Pipe()
+        process = self.context.Process(
+            target=run_worker, args=(index, self.count, child), name=f"worker-{index}", daemon=True
+        )
+        process.start()
+        child.close()
+        channel = IpcChannel(parent)
+        channel.start(functools.partial(self.on_worker_message, index))
+        self.processes[index] = process
+        self.channels[index] = channel
+        self.status.pop(index, None)
+        logger.info(f"🧩 Worker {index} started (pid {process.pid})")
+    
+    async def on_worker_message(self, index, message):
+        if message['op'] == 'status':
+            self.status[index] = message
+        elif message['op'] == 'handoff':
+            self.hand_off(message['chat_id'], message['entries'])
+    
+    async def forward(self, event):
+        """Router replacement: ship the message and its entities to the owning worker"""
+        index = self.ring.node_for(event.chat_id)
+        metrics.inc('bot_commands_forwarded_total', worker=index)
+        self.channels[index].send(
+            'event',
+            message=bytes(event.message),
+            entities=[bytes(entity) for entity in event._entities.values()],
+        )
+    
+    async def watch_workers(self):
+        while True:
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+            for index, process in list(self.processes.items()):
+                if not process.is_alive() and process.exitcode == WORKER_CONFIG_ERROR:
+                    if index not in self.given_up:
+                        self.given_up.add(index)
+                        logger.error(f"❌ Worker {index} cannot start as configured, not restarting it")
+                elif not process.is_alive():
+                    logger.error(f"❌ Worker {index} exited with code {process.exitcode}, restarting")
+                    self.channels[index].close()
+                    self.start_worker(index)
+    
+    def snapshot(self):
+        """Shared status view of all workers"""
+        now = time.time()
+        view = {}
+        for index, process in sorted(self.processes.items()):
+            status = self.status.get(index, {})
+            view[str(index)] = {
+                "alive": process.is_alive(),
+                "pid": process.pid,
+                "chats": len(status.get('chats', [])),
+                "clients": status.get('clients', {}),
+                "status_age": round(now - status['time'], 1) if status else None,
+            }
+        return view
+    
+    def healthy(self):
+        bot = self.front.bot_client
+        if not (bot and bot.is_connected()):
+            return False
+        return all(
+            worker['alive'] and worker['clients'] and all(worker['clients'].values())
+            and worker['status_age'] < 3 * WORKER_STATUS_INTERVAL
+            for worker in self.snapshot().values()
+        )
+    
+    def render_metrics(self):
+        gauges = [
+            ('bot_client_connected', {'client': 'bot'}, int(bool(self.front.bot_client and self.front.bot_client.is_connected()))),
+            ('bot_workers_alive', {}, sum(process.is_alive() for process in self.processes.values())),
+        ]
+        texts = [metrics.render(gauges, extra=[('worker', 'supervisor')])]
+        texts += [status['metrics'] for status in list(self.status.values())]
+        return merge_exposition(texts)
+    
+    async def run(self):
+        """Start the bot account and the workers, then route until disconnected"""
+        try:
+            # Workers boot while the bot account logs in
+            for index in range(self.count):
+                self.start_worker(index)
+            
+            bot_client = TelegramClient('bot_session', 2040, "b18441a1ff500e14f25e2e95ffd20eeb")
+            await bot_client.start(bot_token=BOT_TOKEN)
+            bot_me = await bot_client.get_me()
+            self.front.bot_client = bot_client
+            self.front.outbox.client = bot_client
+            self.front.bot_username = (bot_me.username or '').lower()
+            logger.info(f"✅ BOT account started: @{bot_me.username} (ID: {bot_me.id})")
+            
+            self.front.setup_handlers(route=self.forward)
+            
+            # Queues from a single-process run go to the workers that own them now
+            for chat_id in self.front.queues.pending():
+                self.front.hand_off_queue(chat_id)
+            
+            asyncio.create_task(self.watch_workers())
+            self.front.state = 'running'
+            logger.info(f"🎵 Supervisor routing commands to {self.count} workers")
+            self.front.log_startup()
+            await bot_client.run_until_disconnected()
+        except Exception as e:
+            logger.error(f"Supervisor error: {e}")
+            traceback.print_exc()
+        finally:
+            if self.front.state == 'starting':
+                self.front.state = 'failed'
+            for process in self.processes.values():
+                process.terminate()
+            self.front.downloads.shutdown()
+            self.front.store.close()
 
 # ================= FLASK ROUTES =================
 @app.route('/')
@@ -483,12 +3257,39 @@ def home():
         "service": "Voice Chat Music Bot",
         "architecture": "Bot (token) + User (API ID/HASH)",
         "owners": OWNERS,
+        "entity_cache": {
+            "hits": music_bot.entities.hits if music_bot else 0,
+            "misses": music_bot.entities.misses if music_bot else 0,
+        },
+        "workers": supervisor.snapshot() if supervisor else None,
         "timestamp": time.time()
     })
 
 @app.route('/health')
 def health():
-    return jsonify({"status": "healthy"})
+    # Answer while the clients are still connecting, so platform checks pass during startup
+    running = supervisor.front if supervisor else music_bot
+    if running is None or running.state == 'starting':
+        return jsonify({"status": "starting", "uptime": round(time.perf_counter() - PROCESS_STARTED, 1)}), 200
+    
+    if supervisor:
+        healthy = supervisor.healthy()
+        body = {"status": "healthy" if healthy else "unhealthy", "workers": supervisor.snapshot()}
+        return jsonify(body), 200 if healthy else 503
+    
+    clients = {
+        "bot": bool(music_bot and music_bot.bot_client and music_bot.bot_client.is_connected()),
+        "user": bool(music_bot and music_bot.user_client and music_bot.user_client.is_connected()),
+    }
+    healthy = all(clients.values())
+    return jsonify({"status": "healthy" if healthy else "unhealthy", "clients": clients}), 200 if healthy else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if supervisor:
+        return Response(supervisor.render_metrics(), mimetype='text/plain; version=0.0.4')
+    gauges = music_bot.gauges() if music_bot else []
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
 
 @app.route('/keepalive')
 def keepalive():
@@ -501,12 +3302,80 @@ def run_bot():
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         
-        bot = VoiceChatMusicBot()
-        loop.run_until_complete(bot.run())
+        global music_bot
+        music_bot = VoiceChatMusicBot()
+        loop.run_until_complete(music_bot.run())
     except Exception as e:
         logger.error(f"Bot thread error: {e}")
         traceback.print_exc()
 
+def run_supervisor():
+    """Run the supervisor in thread (WORKERS > 0)"""
+    try:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        
+        global supervisor
+        supervisor = Supervisor()
+        loop.run_until_complete(supervisor.run())
+    except Exception as e:
+        logger.error(f"Supervisor thread error: {e}")
+        traceback.print_exc()
+
+def worker_session_source(index, count):
+    """Session a worker copies its user account from, or None when it has none"""
+    # Workers cannot log in interactively, so they start from an existing session: their own
+    # from WORKER_USER_SESSIONS, or the main account's when there is a single worker. Two
+    # processes sharing one auth key get AUTH_KEY_DUPLICATED and can lose the login
+    if index < len(WORKER_USER_SESSIONS):
+        return WORKER_USER_SESSIONS[index]
+    if count == 1:
+        return 'user_session'
+    return None
+
+def run_worker(index, count, conn):
+    """Entry point of a worker process, which runs in its own SHARD_DIR/<index>"""
+    workdir = os.path.join(SHARD_DIR, str(index))
+    os.makedirs(workdir, exist_ok=True)
+    
+    source = worker_session_source(index, count)
+    if source is None:
+        logger.error(f"❌ Worker {index}: WORKER_USER_SESSIONS has no session for it, not starting")
+        sys.exit(WORKER_CONFIG_ERROR)
+    
+    target = os.path.join(workdir, 'user_session.session')
+    marker = os.path.join(workdir, 'user_session.source')
+    try:
+        with open(marker) as f:
+            copied_from = f.read()
+    except FileNotFoundError:
+        copied_from = None
+    if not os.path.exists(target) or copied_from != source:
+        if os.path.exists(source + '.session'):
+            shutil.copyfile(source + '.session', target)
+            with open(marker, 'w') as f:
+                f.write(source)
+        else:
+            logger.error(f"❌ Worker {index}: no {source}.session, log in once with WORKERS=0 first")
+            sys.exit(WORKER_CONFIG_ERROR)
+    
+    # Extra accounts are split between workers, so no session is open in two processes;
+    # paths are made absolute before leaving the directory they are relative to
+    user_sessions = []
+    for session in USER_SESSIONS[index::count]:
+        if os.path.exists(session + '.session'):
+            user_sessions.append(os.path.abspath(session))
+        else:
+            logger.error(f"❌ Worker {index}: no {session}.session, log in once with WORKERS=0 first")
+    os.chdir(workdir)
+    
+    try:
+        worker_bot = VoiceChatMusicBot(shard=ShardWorker(index, count, conn, user_sessions))
+        asyncio.run(worker_bot.run())
+    except Exception as e:
+        logger.error(f"Worker {index} error: {e}")
+        traceback.print_exc()
+
 def main():
     """Main entry point"""
     # Check environment variables
@@ -523,11 +3392,35 @@ def main():
         logger.error("USER_API_ID, USER_API_HASH = From my.telegram.org (USER account)")
         sys.exit(1)
     
+    if WORKERS > 1 and len(WORKER_USER_SESSIONS) < WORKERS:
+        logger.error(f"❌ WORKERS={WORKERS} needs one user session per worker in WORKER_USER_SESSIONS "
+                     f"(got {len(WORKER_USER_SESSIONS)}); workers cannot share an account's session")
+        sys.exit(1)
+    
+    if WORKERS > 0:
+        worker_sessions = {os.path.abspath(s) for s in ['user_session'] + WORKER_USER_SESSIONS}
+        extra_sessions = [os.path.abspath(s) for s in USER_SESSIONS]
+        if len(set(extra_sessions)) < len(extra_sessions) or worker_sessions & set(extra_sessions):
+            logger.error("❌ USER_SESSIONS must not repeat a session or name one from WORKER_USER_SESSIONS "
+                         "or 'user_session'; workers cannot share an account's session")
+            sys.exit(1)
+        
+        # A worker keeps its copy of the session once made, the source is only needed before that
+        missing = [
+            source for index, source in enumerate(worker_session_source(i, WORKERS) for i in range(WORKERS))
+            if not os.path.exists(source + '.session')
+            and not os.path.exists(os.path.join(SHARD_DIR, str(index), 'user_session.session'))
+        ]
+        missing += [s for s in USER_SESSIONS if not os.path.exists(s + '.session')]
+        if missing:
+            logger.error(f"❌ No session file for {missing}, log in once with WORKERS=0 first")
+            sys.exit(1)
+    
     logger.info("🚀 Starting Voice Chat Music Bot...")
     logger.info(f"👑 Owners: {OWNERS}")
     
-    # Start bot thread
-    bot_thread = threading.Thread(target=run_bot, daemon=True)
+    # Start bot thread (or the supervisor, which starts the worker processes)
+    bot_thread = threading.Thread(target=run_supervisor if WORKERS > 0 else run_bot, daemon=True)
     bot_thread.start()
     
     # Start Flask